@@ -0,0 +1,69 @@
+import argparse
+
+import torch
+from addict import Dict
+
+from deepencoder.build_linear import MlpProjector
+from deepencoder.clip_sdpa import build_clip_l
+from deepencoder.profiler import EncoderProfiler
+from deepencoder.sam_vary_sdpa import build_sam_vit_b
+
+
+# (global view size, local tile size or None, number of tiles), as in config.py
+MODES = {
+    'tiny': (512, None, 0),
+    'small': (640, None, 0),
+    'base': (1024, None, 0),
+    'large': (1280, None, 0),
+    'gundam': (1024, 640, 6),
+}
+
+
+def encode(sam_model, vision_model, projector, images):
+    """the encoder path of DeepseekOCRForCausalLM._pixel_values_to_embedding for one view"""
+    features_1 = sam_model(images)
+    features_2 = vision_model(images, features_1)
+    return projector(torch.cat((features_2[:, 1:], features_1), dim=-1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='per-layer profile of the vision encoders for each resolution mode')
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--tiles', type=int, default=None, help='override the number of gundam tiles')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--dtype', default='bfloat16', choices=['bfloat16', 'float16', 'float32'])
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--iters', type=int, default=3)
+    parser.add_argument('--trace-prefix', default='encoder_profile', help='writes <prefix>_<mode>.json chrome traces')
+    args = parser.parse_args()
+
+    dtype = getattr(torch, args.dtype)
+    sam_model = build_sam_vit_b().to(args.device, dtype).eval()
+    vision_model = build_clip_l().to(args.device, dtype).eval()
+    projector = MlpProjector(Dict(projector_type="linear", input_dim=2048, n_embed=1280)).to(args.device, dtype).eval()
+
+    profiler = EncoderProfiler().attach(sam_model, vision_model, projector)
+
+    for mode in args.modes:
+        base_size, tile_size, num_tiles = MODES[mode]
+        if mode == 'gundam' and args.tiles is not None:
+            num_tiles = args.tiles
+
+        views = [torch.randn(1, 3, base_size, base_size, device=args.device, dtype=dtype)]
+        if num_tiles:
+            views.insert(0, torch.randn(num_tiles, 3, tile_size, tile_size, device=args.device, dtype=dtype))
+
+        with torch.no_grad():
+            for step in range(args.warmup + args.iters):
+                if step == args.warmup:
+                    profiler.reset()
+                for images in views:
+                    encode(sam_model, vision_model, projector, images)
+
+        title = f'{mode}: global {base_size}px' + (f' + {num_tiles} x {tile_size}px tiles' if num_tiles else '')
+        title += f', {args.iters} iters on {args.device} / {args.dtype}'
+        print(profiler.summary_table(title))
+        print()
+        profiler.export_chrome_trace(f'{args.trace_prefix}_{mode}.json')
+
+    profiler.detach()
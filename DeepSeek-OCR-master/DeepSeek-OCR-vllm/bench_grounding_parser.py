@@ -0,0 +1,89 @@
+import argparse
+import random
+import re
+import time
+
+from process.grounding import parse_grounding
+
+
+def legacy_markdown(content, jdx='0'):
+    """the original post-processing: findall + one full-text replace chain per block"""
+    matches = re.findall(r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)', content, re.DOTALL)
+    matches_images = [a_match[0] for a_match in matches if '<|ref|>image<|/ref|>' in a_match[0]]
+    mathes_other = [a_match[0] for a_match in matches if '<|ref|>image<|/ref|>' not in a_match[0]]
+
+    for idx, a_match_image in enumerate(matches_images):
+        content = content.replace(a_match_image, f'![](images/' + jdx + '_' + str(idx) + '.jpg)\n')
+    for idx, a_match_other in enumerate(mathes_other):
+        content = content.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n')
+    return content
+
+
+def block(label, rng):
+    x1, y1 = rng.randint(0, 900), rng.randint(0, 900)
+    return f'<|ref|>{label}<|/ref|><|det|>[[{x1}, {y1}, {x1 + rng.randint(1, 99)}, {y1 + rng.randint(1, 99)}]]<|/det|>\n'
+
+
+def synthetic_page(rng, num_tables, rows, cols):
+    """a table-heavy page: title, paragraphs, a figure and `num_tables` html tables"""
+    parts = [block('title', rng), '# Quarterly results\n\n']
+    for table_idx in range(num_tables):
+        parts.append(block('text', rng))
+        parts.append(f'Table {table_idx} summarizes the figures, where $x \\coloneqq y$ holds.\n\n')
+        parts.append(block('table', rng))
+        cells = ''.join('<tr>' + ''.join(f'<td>{rng.randint(0, 10 ** 6)}</td>' for _ in range(cols)) + '</tr>'
+                        for _ in range(rows))
+        parts.append(f'<table>{cells}</table>\n\n')
+        if table_idx % 4 == 0:
+            parts.append(block('image', rng) + '\n\n')
+    return ''.join(parts)
+
+
+def ms_per_page(func, pages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            func(page)
+    return (time.perf_counter() - start) * 1000 / (repeat * len(pages))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='grounding post-processing: replace chains vs single-pass parser')
+    parser.add_argument('--det-mmd', nargs='*', default=[], help='real *_det.mmd outputs to time instead of synthetic pages')
+    parser.add_argument('--tables', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--rows', type=int, default=20)
+    parser.add_argument('--cols', type=int, default=8)
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    suites = []
+    if args.det_mmd:
+        pages = []
+        for path in args.det_mmd:
+            with open(path, 'r', encoding='utf-8') as afile:
+                pages.extend(page for page in afile.read().split('\n<--- Page Split --->') if page.strip())
+        suites.append(('det.mmd', pages))
+    else:
+        rng = random.Random(0)
+        for num_tables in args.tables:
+            suites.append((f'{num_tables} tables', [synthetic_page(rng, num_tables, args.rows, args.cols)
+                                                     for _ in range(args.pages)]))
+
+    print(f'{"pages":<14}{"chars/page":>12}{"blocks/page":>13}{"legacy ms":>12}{"parser ms":>12}{"speedup":>9}{"same":>6}')
+    for name, pages in suites:
+        parse = lambda page: parse_grounding(page, image_link=lambda idx: f'images/0_{idx}.jpg')
+        # the legacy chain only collapses newlines as often as there are blocks; compare at its fixpoint
+        same = True
+        for page in pages:
+            expected = legacy_markdown(page)
+            while '\n\n\n' in expected:
+                expected = expected.replace('\n\n\n', '\n\n')
+            same &= expected == parse(page).markdown
+
+        legacy_ms = ms_per_page(legacy_markdown, pages, args.repeat)
+        parser_ms = ms_per_page(parse, pages, args.repeat)
+        chars = sum(len(page) for page in pages) / len(pages)
+        blocks = sum(page.count('<|/det|>') for page in pages) / len(pages)
+        print(f'{name:<14}{chars:>12.0f}{blocks:>13.1f}{legacy_ms:>12.3f}{parser_ms:>12.3f}'
+              f'{legacy_ms / parser_ms:>8.1f}x{str(same):>6}')
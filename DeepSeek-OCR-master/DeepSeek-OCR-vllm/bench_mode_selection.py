@@ -0,0 +1,70 @@
+import argparse
+import glob
+import json
+import os
+import time
+
+from config import ADAPTIVE_MIN_GLYPH_PX, ADAPTIVE_MAX_COMPRESSION
+from process.image_process import count_image_tokens
+from process.mode_select import CONFIG_MODE, MODES, mode_name, select_mode, text_lines
+from bench_page_order import iter_pages
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp', '.pdf')
+
+
+def expand_paths(paths):
+    """folders (e.g. OmniDocBench/images) are expanded to the images and pdfs in them"""
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(p for p in glob.glob(f'{path}/*') if p.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            yield path
+
+
+def vision_tokens(image, mode):
+    return count_image_tokens(image.width, image.height, cropping=mode.crop_mode,
+                              base_size=mode.base_size, image_size=mode.image_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='vision tokens of adaptive per-page mode selection vs the config mode; '
+                                                 'pair with eval batch runs (ADAPTIVE_MODE on / off) for the accuracy side')
+    parser.add_argument('paths', nargs='+', help='page images, pdfs and/or folders of them (OmniDocBench images)')
+    parser.add_argument('--min-glyph-px', type=float, nargs='+', default=[ADAPTIVE_MIN_GLYPH_PX],
+                        help='thresholds to compare (text line height in the views)')
+    parser.add_argument('--max-compression', type=float, default=ADAPTIVE_MAX_COMPRESSION)
+    parser.add_argument('--out', default=None,
+                        help='jsonl with the chosen mode of every page, to join with per-page edit distances')
+    args = parser.parse_args()
+
+    pages = []
+    start = time.perf_counter()
+    for name, page_idx, image in iter_pages(expand_paths(args.paths)):
+        lines = text_lines(image)
+        modes = [select_mode(image, min_glyph_px=threshold, max_compression=args.max_compression)
+                 for threshold in args.min_glyph_px]
+        pages.append(dict(doc=name, page=page_idx, lines=lines.count, line_height=round(lines.line_height, 5),
+                          fixed_tokens=vision_tokens(image, CONFIG_MODE),
+                          modes=[mode_name(mode) for mode in modes],
+                          tokens=[vision_tokens(image, mode) for mode in modes]))
+    elapsed = time.perf_counter() - start
+    print(f'{len(pages)} pages, selection {elapsed / max(len(pages), 1) * 1e3:.1f} ms/page (load included), '
+          f'config mode {mode_name(CONFIG_MODE)}')
+
+    fixed = sum(page['fixed_tokens'] for page in pages)
+    names = list(MODES) + sorted({name for page in pages for name in page['modes']} - set(MODES))
+    print(f'{"min glyph px":<14}{"tokens":>12}{"saved":>9}  ' + ''.join(f'{name:>8}' for name in names))
+    print(f'{"fixed":<14}{fixed:>12}{"":>9}')
+    for column, threshold in enumerate(args.min_glyph_px):
+        total = sum(page['tokens'][column] for page in pages)
+        counts = {name: 0 for name in names}
+        for page in pages:
+            counts[page['modes'][column]] += 1
+        print(f'{threshold:<14g}{total:>12}{1 - total / max(fixed, 1):>8.1%}  ' + ''.join(f'{counts[name]:>8}' for name in names))
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as afile:
+            for page in pages:
+                record = dict(page, min_glyph_px=args.min_glyph_px)
+                afile.write(json.dumps(record, ensure_ascii=False) + '\n')
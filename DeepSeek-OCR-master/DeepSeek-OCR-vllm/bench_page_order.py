@@ -0,0 +1,99 @@
+import argparse
+import json
+import os
+import time
+from functools import partial
+
+from PIL import Image
+
+from config import MAX_CONCURRENCY, MAX_NUM_SEQS, RENDER_OVERSAMPLE
+from process.image_process import plan_render_dpi
+from process.page_order import estimate_cost, plan_order, simulate_makespan
+from process.pdf_render import iter_pdf_images
+
+
+def iter_pages(paths):
+    """(doc name, page idx, image) as the pdf runner sees them, pdfs rendered at the planned dpi"""
+    dpi = partial(plan_render_dpi, oversample=RENDER_OVERSAMPLE)
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        if path.lower().endswith('.pdf'):
+            for page_idx, image in iter_pdf_images(path, dpi=dpi):
+                yield name, page_idx, image
+        else:
+            yield name, 0, Image.open(path).convert('RGB')
+
+
+def load_output_tokens(metrics_path):
+    """(doc, page) -> output tokens, from the metrics.jsonl of an earlier run on the same input"""
+    tokens = {}
+    with open(metrics_path, 'r', encoding='utf-8') as afile:
+        for line in afile:
+            record = json.loads(line)
+            if 'output_tokens' in record:
+                tokens[(record['doc'], record['page'])] = record['output_tokens']
+    return tokens
+
+
+def windowed_order(costs, window):
+    order = []
+    for start in range(0, len(costs), window):
+        order += [start + idx for idx in plan_order(costs[start:start + window])]
+    return order
+
+
+def rank_correlation(xs, ys):
+    """spearman rank correlation, ties broken by position"""
+    def ranks(values):
+        result = [0] * len(values)
+        for rank, idx in enumerate(sorted(range(len(values)), key=values.__getitem__)):
+            result[idx] = rank
+        return result
+    rx, ry = ranks(xs), ranks(ys)
+    n = len(xs)
+    if n < 2:
+        return float('nan')
+    return 1 - 6 * sum((a - b) ** 2 for a, b in zip(rx, ry)) / (n * (n * n - 1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='decode makespan of length-aware page order vs input order')
+    parser.add_argument('paths', nargs='+', help='pdfs and/or page images')
+    parser.add_argument('--slots', type=int, default=MAX_NUM_SEQS, help='max_num_seqs')
+    parser.add_argument('--windows', type=int, nargs='+', default=[MAX_CONCURRENCY],
+                        help='order window sizes to simulate (pdf/corpus runner)')
+    parser.add_argument('--metrics', default=None,
+                        help='metrics.jsonl of an earlier run; its output_tokens are used as the true lengths')
+    args = parser.parse_args()
+
+    keys, costs = [], []
+    start = time.perf_counter()
+    for name, page_idx, image in iter_pages(args.paths):
+        keys.append((name, page_idx))
+        costs.append(estimate_cost(image))
+    print(f'{len(costs)} pages, cost estimate {(time.perf_counter() - start) / max(len(costs), 1) * 1e3:.1f} ms/page '
+          f'(render included), {args.slots} slots')
+
+    predicted = [cost.decode_tokens for cost in costs]
+    lengths = {'predicted': predicted}
+    if args.metrics:
+        output_tokens = load_output_tokens(args.metrics)
+        missing = sum(1 for key in keys if key not in output_tokens)
+        if missing:
+            print(f'{missing} pages not in {args.metrics}, their predicted length is used')
+        actual = [output_tokens.get(key, length) for key, length in zip(keys, predicted)]
+        lengths['actual'] = actual
+        print(f'rank correlation predicted / actual output length: {rank_correlation(predicted, actual):.3f}')
+
+    orders = {'input': list(range(len(costs))), 'whole batch': plan_order(costs)}
+    for window in args.windows:
+        orders[f'window {window}'] = windowed_order(costs, window)
+
+    print(f'{"order":<16}' + ''.join(f'{kind + " steps":>18}' for kind in lengths))
+    baseline = {kind: simulate_makespan(values, args.slots) for kind, values in lengths.items()}
+    for label, order in orders.items():
+        row = f'{label:<16}'
+        for kind, values in lengths.items():
+            steps = simulate_makespan([values[idx] for idx in order], args.slots)
+            row += f'{steps:>10} ({steps / max(baseline[kind], 1):.2f}x)'
+        print(row)
@@ -0,0 +1,52 @@
+import argparse
+import io
+import time
+
+import fitz
+from PIL import Image
+
+from process.pdf_render import PdfRenderPool, get_page_count, iter_pdf_images
+
+
+def legacy_pdf_images(pdf_path, dpi=144):
+    """the original loop: serial render + png encode/decode round trip per page"""
+    pdf_document = fitz.open(pdf_path)
+    zoom = dpi / 72.0
+    matrix = fitz.Matrix(zoom, zoom)
+    for page_num in range(pdf_document.page_count):
+        pixmap = pdf_document[page_num].get_pixmap(matrix=matrix, alpha=False)
+        Image.MAX_IMAGE_PIXELS = None
+        img = Image.open(io.BytesIO(pixmap.tobytes("png")))
+        img.load()
+        yield page_num, img
+    pdf_document.close()
+
+
+def pages_per_sec(pages, num_pages):
+    start = time.perf_counter()
+    for _ in pages:
+        pass
+    return num_pages / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='pdf rasterization throughput vs render workers')
+    parser.add_argument('pdf_path')
+    parser.add_argument('--dpi', type=int, default=144)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    num_pages = get_page_count(args.pdf_path)
+    print(f'{args.pdf_path}: {num_pages} pages @ {args.dpi} dpi')
+    print(f'{"renderer":<24}{"pages/s":>10}')
+
+    rate = pages_per_sec(legacy_pdf_images(args.pdf_path, args.dpi), num_pages)
+    print(f'{"serial + png roundtrip":<24}{rate:>10.2f}')
+
+    rate = pages_per_sec(iter_pdf_images(args.pdf_path, args.dpi), num_pages)
+    print(f'{"serial raw":<24}{rate:>10.2f}')
+
+    for num_workers in args.workers:
+        with PdfRenderPool(num_workers) as render_pool:
+            rate = pages_per_sec(render_pool.iter_pages(args.pdf_path, dpi=args.dpi), num_pages)
+        print(f'{f"pool x{num_workers}":<24}{rate:>10.2f}')
@@ -0,0 +1,117 @@
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from deepencoder import sam_vary_sdpa
+from deepencoder.sam_vary_sdpa import build_sam_vit_b, window_partition, window_unpartition
+
+
+def legacy_window_partition(x, window_size):
+    B, H, W, C = x.shape
+
+    pad_h = (window_size - H % window_size) % window_size
+    pad_w = (window_size - W % window_size) % window_size
+    if pad_h > 0 or pad_w > 0:
+        x = F.pad(x, (0, 0, 0, pad_w, 0, pad_h))
+    Hp, Wp = H + pad_h, W + pad_w
+
+    x = x.view(B, Hp // window_size, window_size, Wp // window_size, window_size, C)
+    windows = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(-1, window_size, window_size, C)
+    return windows, (Hp, Wp)
+
+
+def legacy_window_unpartition(windows, window_size, pad_hw, hw, residual=None):
+    Hp, Wp = pad_hw
+    H, W = hw
+    B = windows.shape[0] // (Hp * Wp // window_size // window_size)
+    x = windows.view(B, Hp // window_size, Wp // window_size, window_size, window_size, -1)
+    x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, Hp, Wp, -1)
+
+    if Hp > H or Wp > W:
+        x = x[:, :H, :W, :].contiguous()
+    if residual is not None:
+        x = residual + x
+    return x
+
+
+def timeit(fn, iters, device):
+    for _ in range(3):
+        fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def bench_partition(batch, tokens, window_size, dtype, device, iters):
+    x = torch.randn(batch, tokens, tokens, 768, dtype=dtype, device=device)
+    shortcut = torch.randn_like(x)
+
+    def legacy():
+        windows, pad_hw = legacy_window_partition(x, window_size)
+        return legacy_window_unpartition(windows, window_size, pad_hw, (tokens, tokens), residual=shortcut)
+
+    def strided():
+        windows, pad_hw = window_partition(x, window_size)
+        return window_unpartition(windows, window_size, pad_hw, (tokens, tokens), residual=shortcut)
+
+    ref_windows, _ = legacy_window_partition(x, window_size)
+    new_windows, _ = window_partition(x, window_size)
+    assert torch.equal(ref_windows, new_windows)
+    assert torch.equal(legacy(), strided())
+
+    return timeit(legacy, iters, device), timeit(strided, iters, device)
+
+
+@torch.no_grad()
+def bench_encoder(batch, image_size, dtype, device, iters):
+    model = build_sam_vit_b().to(device=device, dtype=dtype).eval()
+    # non-zero rel-pos so the padded keys actually matter
+    for p in model.parameters():
+        p.normal_(std=0.02)
+    x = torch.randn(batch, 3, image_size, image_size, dtype=dtype, device=device)
+
+    new_out = model(x)
+    new_ms = timeit(lambda: model(x), iters, device)
+
+    sam_vary_sdpa.window_partition = legacy_window_partition
+    sam_vary_sdpa.window_unpartition = legacy_window_unpartition
+    try:
+        ref_out = model(x)
+        ref_ms = timeit(lambda: model(x), iters, device)
+    finally:
+        sam_vary_sdpa.window_partition = window_partition
+        sam_vary_sdpa.window_unpartition = window_unpartition
+
+    max_diff = (ref_out.float() - new_out.float()).abs().max().item()
+    return ref_ms, new_ms, max_diff
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='window partition/unpartition: F.pad + permute copies vs strided views')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--encoder', action='store_true', help='also time the full SAM encoder')
+    args = parser.parse_args()
+
+    dtype = torch.bfloat16 if args.device == 'cuda' else torch.float32
+
+    # (name, batch, image size): Gundam local crops are 640px, the global view 1024px
+    cases = [('640px x6', 6, 640), ('1024px x1', 1, 1024)]
+
+    print(f'{"input":<12}{"legacy ms":>12}{"strided ms":>12}{"speedup":>10}')
+    for name, batch, image_size in cases:
+        legacy_ms, new_ms = bench_partition(batch, image_size // 16, 14, dtype, args.device, args.iters)
+        print(f'{name:<12}{legacy_ms:>12.3f}{new_ms:>12.3f}{legacy_ms / new_ms:>9.2f}x')
+
+    if args.encoder:
+        print(f'\n{"encoder":<12}{"legacy ms":>12}{"strided ms":>12}{"max diff":>12}')
+        for name, batch, image_size in cases:
+            legacy_ms, new_ms, max_diff = bench_encoder(batch, image_size, dtype, args.device, args.iters)
+            print(f'{name:<12}{legacy_ms:>12.3f}{new_ms:>12.3f}{max_diff:>12.2e}')
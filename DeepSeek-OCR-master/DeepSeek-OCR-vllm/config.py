@@ -8,18 +8,66 @@
 BASE_SIZE = 1024
 IMAGE_SIZE = 640
 CROP_MODE = True
+ADAPTIVE_MODE = False # pdf/corpus runs and the eval batch: each page gets the smallest mode (up to the one above) its text line height and density need; retries use the mode above
+# experimental: the two thresholds below are unvalidated starting points, not measured on OmniDocBench; check the
+# savings (bench_mode_selection.py) and the accuracy (eval batch with and without ADAPTIVE_MODE) before enabling it
+ADAPTIVE_MIN_GLYPH_PX = 12 # text line height a mode must give in its views
+ADAPTIVE_MAX_COMPRESSION = 10 # predicted output tokens per vision token a mode may be asked to decode
 MIN_CROPS= 2
 MAX_CROPS= 6 # max:9; If your GPU memory is small, it is recommended to set it to 6.
 MAX_CONCURRENCY = 100 # If you have limited GPU memory, lower the concurrency count.
+KV_ADMISSION = True # pdf/corpus runs and server pdfs: pages are admitted while their prompt + planned max_tokens fit the KV cache (no manual tuning for memory)
+KV_ADMISSION_HEADROOM = 4.0 # planned max_tokens = this x the page's predicted output length, at least 2048; pages cut off by it re-run with the full max_tokens
+MAX_NUM_SEQS = 2 * MAX_CONCURRENCY if KV_ADMISSION else MAX_CONCURRENCY # engine max_num_seqs of the pdf runner / server; with KV_ADMISSION only a cap
 NUM_WORKERS = 64 # image pre-process (resize/padding) workers 
+RENDER_WORKERS = 8 # pdf rasterization processes; 0 renders serially in the main process
+RENDER_DPI = None # fixed pdf render dpi (e.g. 144); None renders each page at the size the tile planner needs
+RENDER_OVERSAMPLE = 1.0 # with RENDER_DPI = None, render this much above the planned size
+QUEUE_DEPTH = MAX_CONCURRENCY + 16 # pdf pages in flight between render and write, each holding its image and preprocessed tensors; bounds peak host memory and caps the pages of one run in the engine
+LENGTH_ORDER = True # submit the pages predicted to decode longest first (tile plan + ink density); the eval batch runner orders the whole batch
+ORDER_WINDOW = MAX_CONCURRENCY # pdf/corpus runs order within windows of this many pages; output order is kept
+RESUME = True # pdf/corpus runs journal every finished page to OUTPUT_PATH/journal.jsonl and skip journaled pages on restart
+RESULT_CACHE_PATH = None # pdf/corpus runs: sqlite file of finished pages by (pixels, prompt, mode, sampling params), shared by all runs and documents that point at it; None disables
+RESULT_CACHE_MAX_MB = 1024 # least recently used pages are evicted beyond this much text
+SKIP_BLANK_PAGES = True # pdf/corpus runs and the eval batch: pages with no ink (dark pixel share <= BLANK_MAX_DARK) get an empty result without a model call
+BLANK_MAX_DARK = 5e-5 # a lone page number is ~1e-4
+REUSE_NEAR_DUPLICATES = False # pages nearly identical to a recent one reuse its text instead of being decoded; also merges a form filled in slightly differently
+HYBRID_TEXT_LAYER = False # pdf pages with a good embedded text layer skip the model; sources go to <name>_pages.jsonl
+TEXT_LAYER_MIN_SCORE = 0.9 # 0..1 text layer quality needed to skip ocr in hybrid mode
+LAYOUT_JPEG_QUALITY = 95 # jpeg quality of the pages in <name>_layouts.pdf
+LAYOUT_MAX_SIDE = 1600 # layout boxes are drawn on a preview with this longer side (px); None keeps the render resolution
+LAYOUT_WORKERS = 4 # layout page jpeg encoders / figure crop writers
+LAYOUT_TABLE = 'document' # columnar layout blocks: 'document' (<name>_layout.parquet), 'corpus' (OUTPUT_PATH/layout.parquet) or None; .npz without pyarrow
+# pdf pages that end without eos are re-run with each step in turn until one finishes (same engine, page order kept);
+# keys: ngram_size / window_size (no-repeat logits processor), crop_mode, max_tokens. [] skips them as before
+RETRY_POLICY = [
+    dict(ngram_size=30, window_size=90),
+    dict(ngram_size=30, window_size=90, crop_mode=False, max_tokens=4096),
+]
+# priority: lower is scheduled first and preempts running requests of higher values; deadline: seconds after
+# submission, then the request is aborted and returns its partial text (finish_reason 'deadline'), None waits;
+# max_tokens: decode budget. run_dpsk_ocr_image.py and server images are 'interactive', pdf/corpus pages 'bulk'
+REQUEST_CLASSES = {
+    'interactive': dict(priority=0, deadline=None, max_tokens=8192),
+    'bulk': dict(priority=1, deadline=None, max_tokens=8192),
+}
+SERVER_DEADLINES = {'interactive': 120} # server deadlines per class, over the ones above; ?deadline= overrides both
+METRICS = True # pdf/corpus runs: per-page stage timings to OUTPUT_PATH/metrics.jsonl, prometheus text to metrics.prom (at the end / on SIGUSR1)
+METRICS_VISION_ENCODE = False # also time the vision encoder per image (cuda events, in metrics.prom only; not per page)
+SERVER_HOST = '127.0.0.1' # run_dpsk_ocr_server.py
+SERVER_PORT = 8000
+VIEW_CACHE_MB = 128 # gpu memory for encoder outputs of recent tiles / global views by pixel content (blank tiles, repeated headers, logos); 0 disables
 PRINT_NUM_VIS_TOKENS = False
+PROFILE_ENCODER = None # path of a chrome trace of the sam/clip/projector layers, written at exit with a summary table; None disables
 SKIP_REPEAT = True
 MODEL_PATH = 'deepseek-ai/DeepSeek-OCR' # change to your model path
 
 # TODO: change INPUT_PATH
 # .pdf: run_dpsk_ocr_pdf.py; 
+# folder or manifest (.txt, one path per line) of .pdf/.jpg/.png: run_dpsk_ocr_pdf.py (corpus mode); 
 # .jpg, .png, .jpeg: run_dpsk_ocr_image.py; 
 # Omnidocbench images path: run_dpsk_ocr_eval_batch.py
+# no INPUT_PATH: run_dpsk_ocr_server.py, then curl --data-binary @doc.pdf 'http://SERVER_HOST:SERVER_PORT/ocr'
 
 INPUT_PATH = '' 
 OUTPUT_PATH = ''
@@ -6,7 +6,11 @@ from easydict import EasyDict as adict
 import torch
 from torch.nn import functional as F
 from torch import nn
-from flash_attn import flash_attn_qkvpacked_func, flash_attn_func
+try:
+    from flash_attn import flash_attn_qkvpacked_func, flash_attn_func
+except ImportError:
+    # only needed with use_flash_attn=True; lets the encoders run (and be profiled) on cpu
+    flash_attn_qkvpacked_func = flash_attn_func = None
 # from optimus import flash_attn_func
 # from megatron.core import tensor_parallel
 # from megatron.core import parallel_state as mpu
@@ -136,15 +140,14 @@ class CLIPVisionEmbeddings(nn.Module):
 
 
         if patch_embeds is not None:
+            # sam output is already flattened tokens: [*, grid * grid, width]
             patch_embeds = patch_embeds
             # print(patch_embeds.shape)
         else:
             patch_embeds = self.patch_embedding(pixel_values)  
             # print(111111)
-        # shape = [*, width, grid, grid]
-        # patch_embeds = patch_embeds.flatten(2).transpose(1, 2)
-
-        patch_embeds = patch_embeds.flatten(2).transpose(1, 2)
+            # shape = [*, width, grid, grid]
+            patch_embeds = patch_embeds.flatten(2).transpose(1, 2)
 
 
         class_embeds = self.class_embedding.expand(batch_size, 1, -1)
@@ -499,6 +502,6 @@ if __name__ == '__main__':
         y = vision_model(x, patch_embed)
         print(y.shape)
 
-        image_feature = torch.add(y[:, 1:], patch_embed.flatten(2).permute(0, 2, 1))
+        image_feature = torch.add(y[:, 1:], patch_embed)
 
         print(image_feature.shape)
@@ -0,0 +1,111 @@
+from collections import OrderedDict
+
+import torch
+
+
+class ViewEmbeddingCache:
+    """
+    Content-addressed cache of projected view embeddings (sam + clip + projector output),
+    for 640 px tiles and global views alike. Background tiles and headers, footers and
+    logos repeated across pages are encoded once.
+
+    Views are keyed by two 64-bit linear hashes of their raw bits (computed on the device,
+    one sync per batch) plus shape and dtype. A hit is not confirmed by comparing pixels:
+    two different views of the same shape collide with probability at most 2**-64 (odd
+    random weights, word differences below 2**32; ~2**-126 for most), and a collision
+    serves the cached view's features for the new one. The weights are fixed per view
+    size, so the bound is for ordinary pages, not ones crafted against them. The
+    cache lives on the device and holds at most `max_bytes`, hash weights (16 bytes per
+    32-bit word, ~25 MB for a bf16 1024 view, at most half the budget; views too large for
+    that are not cached) included; least recently used entries go first.
+
+    Before the engine has sized its KV cache (its profiling run) call reserve() instead of
+    encode(): the encoders then see every dummy view, and the cache's memory plus the
+    hashing temporaries are held so the profiling counts them. The first encode() releases it.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.weight_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._weights = {}
+        self._reserved = None
+
+    def reserve(self, images):
+        # int64 copy of a view and its product with both weight rows while hashing
+        view_bytes = images[0].numel() * images[0].element_size()
+        size = self.max_bytes + 24 * view_bytes // self._word_dtype(images[0]).itemsize
+        if self._reserved is None or self._reserved.numel() < size:
+            self._reserved = None
+            self._reserved = torch.empty(size, dtype=torch.uint8, device=images.device)
+
+    def _hash_weights(self, numel, device):
+        """None when the weights for views this size would not fit next to the other ones"""
+        weights = self._weights.get((numel, device))
+        if weights is None:
+            size = 2 * numel * 8
+            if self.weight_bytes + size > self.max_bytes // 2:
+                return None
+            generator = torch.Generator().manual_seed(numel)
+            weights = torch.randint(-2 ** 62, 2 ** 62, (2, numel), generator=generator, dtype=torch.int64) | 1
+            weights = self._weights[(numel, device)] = weights.to(device)
+            self.weight_bytes += size
+            self._evict()
+        return weights
+
+    @staticmethod
+    def _word_dtype(view):
+        """views are hashed as 32-bit words, 16-bit ones for an odd number of bf16 values"""
+        return torch.int32 if view.numel() * view.element_size() % 4 == 0 else torch.int16
+
+    def keys(self, images):
+        """one key per view of `images` [N, C, H, W], None for views too large to hash within the budget"""
+        flat = images.contiguous().view(images.shape[0], -1)
+        bits = flat.view(self._word_dtype(images[0]))
+        weights = self._hash_weights(bits.shape[1], bits.device)
+        if weights is None:
+            return None
+        # one view at a time keeps the int64 temporaries small; sums wrap mod 2**64
+        hashes = torch.stack([(row.to(torch.int64) * weights).sum(dim=1) for row in bits]).tolist()
+        shape = (tuple(images.shape[1:]), images.dtype)
+        return [(shape, *hash_pair) for hash_pair in hashes]
+
+    def encode(self, images, encode_views):
+        """encode_views(images) with every cached view taken from the cache, only the misses encoded (once each)"""
+        self._reserved = None
+        keys = self.keys(images)
+        if keys is None:
+            return encode_views(images)
+        features = [self.entries.get(key) for key in keys]
+
+        missing = OrderedDict() # key -> first index with it
+        for idx, (key, feature) in enumerate(zip(keys, features)):
+            if feature is None:
+                missing.setdefault(key, idx)
+            else:
+                self.entries.move_to_end(key)
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            encoded = encode_views(images[list(missing.values())])
+            for key, feature in zip(missing, encoded):
+                self._put(key, feature)
+            new = dict(zip(missing, encoded))
+            features = [feature if feature is not None else new[key] for key, feature in zip(keys, features)]
+        return torch.stack(features)
+
+    def _put(self, key, feature):
+        # a copy, not a view that would keep the whole encoded batch alive
+        feature = feature.clone()
+        self.entries[key] = feature
+        self.bytes += feature.numel() * feature.element_size()
+        self._evict()
+
+    def _evict(self):
+        while self.bytes + self.weight_bytes > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.numel() * evicted.element_size()
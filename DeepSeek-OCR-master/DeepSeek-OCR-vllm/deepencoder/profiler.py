@@ -0,0 +1,262 @@
+import json
+import math
+import time
+from collections import OrderedDict, deque
+
+import torch
+import torch.nn as nn
+
+
+def _conv_out(size, conv, dim):
+    return (size + 2 * conv.padding[dim] - conv.kernel_size[dim]) // conv.stride[dim] + 1
+
+
+def _conv_flops(conv, height, width, batch=1):
+    """2 * MACs of a Conv2d on a height x width input; returns (flops, out height, out width)"""
+    out_h, out_w = _conv_out(height, conv, 0), _conv_out(width, conv, 1)
+    return 2 * batch * out_h * out_w * conv.weight.numel(), out_h, out_w
+
+
+def sam_patch_embed_flops(module, x):
+    return _conv_flops(module.proj, x.shape[2], x.shape[3], x.shape[0])[0]
+
+
+def sam_block_flops(block, x):
+    """
+    x: [B, H, W, C]. Window blocks attend within ws x ws windows over the zero-padded
+    grid, global blocks over all H * W tokens.
+    """
+    B, H, W, C = x.shape
+    mlp_dim = block.mlp.lin1.out_features
+    ws = block.window_size
+    if ws > 0:
+        num_windows, side_h, side_w = B * math.ceil(H / ws) * math.ceil(W / ws), ws, ws
+    else:
+        num_windows, side_h, side_w = B, H, W
+    seq = side_h * side_w
+    tokens = num_windows * seq
+
+    flops = 2 * tokens * C * 3 * C            # qkv
+    flops += 2 * 2 * num_windows * seq * seq * C  # q @ k^T, attn @ v
+    if block.attn.use_rel_pos:
+        flops += 2 * tokens * (side_h + side_w) * C  # decomposed rel pos einsums
+    flops += 2 * tokens * C * C               # proj
+    flops += 2 * 2 * B * H * W * C * mlp_dim  # mlp, on the unpadded tokens
+    return flops
+
+
+def sam_neck_flops(encoder, x):
+    B, H, W, _ = x.shape
+    conv1, _, conv2, _ = encoder.neck
+    flops = 0
+    for conv in (conv1, conv2, encoder.net_2, encoder.net_3):
+        conv_flops, H, W = _conv_flops(conv, H, W, B)
+        flops += conv_flops
+    return flops
+
+
+def clip_layer_flops(layer, x):
+    """x: [B, N, C], global attention over all N tokens (cls included)"""
+    B, N, C = x.shape
+    ffn_dim = layer.mlp.fc1.out_features
+    return 2 * B * N * C * 4 * C + 2 * 2 * B * N * N * C + 2 * 2 * B * N * C * ffn_dim
+
+
+def projector_flops(projector, x):
+    tokens = x.numel() // x.shape[-1]
+    return sum(2 * tokens * linear.in_features * linear.out_features
+               for linear in projector.modules() if isinstance(linear, nn.Linear))
+
+
+class _Span:
+    __slots__ = ('name', 'category', 'kind', 'flops', 'child_flops', 'shape', 'cuda',
+                 'start', 'end', 'mem_before', 'peak')
+
+    def __init__(self, name, category, kind, flops, shape, cuda):
+        self.name = name
+        self.category = category
+        self.kind = kind
+        self.flops = flops
+        self.child_flops = 0
+        self.shape = shape
+        self.cuda = cuda
+        self.mem_before = 0
+        self.peak = 0
+
+
+class EncoderProfiler:
+    """
+    Opt-in per-layer profiler for the vision encoders (SAM ImageEncoderViT, CLIP VitModel,
+    MlpProjector), attached through forward hooks, so the model code is not touched.
+
+    Every call of a watched module becomes a span with wall time (cuda-synchronized on
+    gpu), analytical FLOPs and, on gpu, the peak memory allocated above what was live
+    when it started. SAM blocks are labelled `window` or `global`.
+    Export with export_chrome_trace() (chrome://tracing, perfetto) or summary_table().
+    Spans reset the global cuda peak counter, so attach it only after anything reading
+    that counter is done (vllm sizes its KV cache from it).
+
+    Args:
+        max_spans: spans kept for the trace; the summary covers every call regardless.
+    """
+
+    def __init__(self, max_spans=100000):
+        self.spans = deque(maxlen=max_spans)
+        self.totals = OrderedDict() # name -> [kind, calls, seconds, flops, peak bytes]
+        self._open = []
+        self._handles = []
+        self._restore = []
+        self._origin = None
+
+    def attach(self, sam_model=None, vision_model=None, projector=None):
+        if sam_model is not None:
+            self._watch(sam_model, 'sam', 'sam', 'encoder')
+            self._watch(sam_model.patch_embed, 'sam.patch_embed', 'sam', 'embed', sam_patch_embed_flops)
+            for idx, block in enumerate(sam_model.blocks):
+                kind = 'window' if block.window_size > 0 else 'global'
+                self._watch(block, f'sam.block{idx}', 'sam', kind, sam_block_flops)
+            self._wrap_method(sam_model, 'forward_neck', 'sam.neck', 'sam', 'neck', sam_neck_flops)
+
+        if vision_model is not None:
+            self._watch(vision_model, 'clip', 'clip', 'encoder')
+            for idx, layer in enumerate(vision_model.transformer.layers):
+                self._watch(layer, f'clip.layer{idx}', 'clip', 'global', clip_layer_flops)
+
+        if projector is not None:
+            self._watch(projector, 'projector', 'projector', 'mlp', projector_flops)
+        return self
+
+    @property
+    def attached(self):
+        return bool(self._handles)
+
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        for module, attr in self._restore:
+            delattr(module, attr)
+        self._handles, self._restore = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def reset(self):
+        self.spans.clear()
+        self.totals.clear()
+        self._origin = None
+
+    def _watch(self, module, name, category, kind, flops_fn=None):
+        def pre_hook(module, args):
+            self._begin(name, category, kind, args[0], flops_fn(module, args[0]) if flops_fn else None)
+
+        def post_hook(module, args, output):
+            self._end()
+
+        self._handles.append(module.register_forward_pre_hook(pre_hook))
+        self._handles.append(module.register_forward_hook(post_hook))
+
+    def _wrap_method(self, module, attr, name, category, kind, flops_fn):
+        """for code paths that are plain methods rather than submodules"""
+        method = getattr(module, attr)
+
+        def wrapped(x, *args, **kwargs):
+            self._begin(name, category, kind, x, flops_fn(module, x))
+            try:
+                return method(x, *args, **kwargs)
+            finally:
+                self._end()
+
+        setattr(module, attr, wrapped)
+        self._restore.append((module, attr))
+
+    def _fold_peak(self):
+        peak = torch.cuda.max_memory_allocated()
+        for span in self._open:
+            span.peak = max(span.peak, peak)
+
+    def _now(self, cuda):
+        if cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _begin(self, name, category, kind, x, flops):
+        cuda = x.is_cuda
+        span = _Span(name, category, kind, flops, tuple(x.shape), cuda)
+        if cuda:
+            # outer spans keep their peak, the counter restarts for this one
+            self._fold_peak()
+            torch.cuda.reset_peak_memory_stats()
+            span.mem_before = torch.cuda.memory_allocated()
+        span.start = self._now(cuda)
+        if self._origin is None:
+            self._origin = span.start
+        self._open.append(span)
+
+    def _end(self):
+        span = self._open[-1]
+        span.end = self._now(span.cuda)
+        if span.cuda:
+            self._fold_peak()
+        self._open.pop()
+
+        if span.flops is None:
+            span.flops = span.child_flops
+        if self._open:
+            self._open[-1].child_flops += span.flops
+
+        peak = span.peak - span.mem_before if span.cuda else None
+        self.spans.append(span)
+        totals = self.totals.get(span.name)
+        if totals is None:
+            totals = self.totals[span.name] = [span.kind, 0, 0.0, 0, None]
+        totals[1] += 1
+        totals[2] += span.end - span.start
+        totals[3] += span.flops
+        if peak is not None:
+            totals[4] = max(totals[4] or 0, peak)
+
+    def export_chrome_trace(self, path):
+        events = []
+        for span in self.spans:
+            args = {'kind': span.kind, 'input': list(span.shape), 'gflops': span.flops / 1e9}
+            if span.cuda:
+                args['peak_mb'] = (span.peak - span.mem_before) / 2 ** 20
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': (span.start - self._origin) * 1e6,
+                'dur': (span.end - span.start) * 1e6,
+                'pid': 0,
+                'tid': 0,
+                'args': args,
+            })
+        with open(path, 'w') as afile:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, afile)
+
+    def dump(self, trace_path, title='vision encoder profile'):
+        self.export_chrome_trace(trace_path)
+        print(self.summary_table(title))
+
+    def summary_table(self, title=''):
+        lines = [title] if title else []
+        lines.append(f'{"module":<18}{"kind":<8}{"calls":>6}{"ms":>10}{"GFLOPs":>10}{"TFLOP/s":>9}{"peak MB":>9}')
+
+        by_kind = OrderedDict()
+        for name, (kind, calls, seconds, flops, peak) in self.totals.items():
+            peak_text = f'{peak / 2 ** 20:>9.1f}' if peak is not None else f'{"-":>9}'
+            lines.append(f'{name:<18}{kind:<8}{calls:>6}{seconds * 1e3:>10.2f}{flops / 1e9:>10.2f}'
+                         f'{flops / max(seconds, 1e-12) / 1e12:>9.2f}{peak_text}')
+            if kind != 'encoder':
+                kind_totals = by_kind.setdefault(kind, [0.0, 0])
+                kind_totals[0] += seconds
+                kind_totals[1] += flops
+
+        lines.append('')
+        for kind, (seconds, flops) in by_kind.items():
+            lines.append(f'{"all " + kind:<26}{seconds * 1e3:>16.2f}{flops / 1e9:>10.2f}'
+                         f'{flops / max(seconds, 1e-12) / 1e12:>9.2f}')
+        return '\n'.join(lines)
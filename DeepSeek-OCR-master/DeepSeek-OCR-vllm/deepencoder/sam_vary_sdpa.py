@@ -10,7 +10,6 @@ import torch.nn.functional as F
 
 from typing import Optional, Tuple, Type
 from functools import partial
-from flash_attn import flash_attn_qkvpacked_func
 # from .common import LayerNorm2d, MLPBlock
 
 # from mmgpt.model.vision_encoder.flash_4 import _attention_rel_h_rel_w
@@ -72,6 +71,10 @@ class LayerNorm2d(nn.Module):
         x = self.weight[:, None, None] * x + self.bias[:, None, None]
         return x
 
+    def forward_channels_last(self, x: torch.Tensor) -> torch.Tensor:
+        # x: [B, H, W, C]; single fused kernel, no mean/var temporaries
+        return F.layer_norm(x, (x.size(-1),), self.weight, self.bias, self.eps)
+
 
 # This class and its supporting functions below lightly adapted from the ViTDet backbone available at: https://github.com/facebookresearch/detectron2/blob/main/detectron2/modeling/backbone/vit.py # noqa
 class ImageEncoderViT(nn.Module):
@@ -175,12 +178,33 @@ class ImageEncoderViT(nn.Module):
         for blk in self.blocks:
             x = blk(x)
 
-        neck_output  = self.neck(x.permute(0, 3, 1, 2))
-        conv2_output  = self.net_2(neck_output)
+        return self.forward_neck(x)
+
+    def forward_neck(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Channels-last neck + downsampling convs.
+        Args:
+            x (tensor): block output with [B, H, W, C].
+
+        Returns:
+            tokens with [B, H/4 * W/4, 1024], the layout the projector consumes.
+        """
+        conv1, norm1, conv2, norm2 = self.neck
+
+        # 1x1 conv == linear over the channel dim, no layout change needed
+        x = F.linear(x, conv1.weight.flatten(1))
+        x = norm1.forward_channels_last(x)
+
+        # BHWC permuted to BCHW is already channels_last memory format, so the
+        # convs below run without any NCHW copies
+        x = conv2(x.permute(0, 3, 1, 2)).permute(0, 2, 3, 1)
+        x = norm2.forward_channels_last(x)
+
+        x = self.net_2(x.permute(0, 3, 1, 2))
         # print(f"conv2_output shape: {conv2_output.shape}")
-        conv3_output  = self.net_3(conv2_output)
+        x = self.net_3(x)
 
-        return conv3_output 
+        return x.permute(0, 2, 3, 1).flatten(1, 2)
 
 
 class Block(nn.Module):
@@ -239,11 +263,12 @@ class Block(nn.Module):
             x, pad_hw = window_partition(x, self.window_size)
 
         x = self.attn(x)
-        # Reverse window partition
+        # Reverse window partition, fused with the residual add
         if self.window_size > 0:
-            x = window_unpartition(x, self.window_size, pad_hw, (H, W))
+            x = window_unpartition(x, self.window_size, pad_hw, (H, W), residual=shortcut)
+        else:
+            x = shortcut + x
 
-        x = shortcut + x
         x = x + self.mlp(self.norm2(x))
 
         return x
@@ -323,9 +348,42 @@ class Attention(nn.Module):
         return x
 
 
+def _window_regions(H: int, W: int, window_size: int):
+    """
+    Split an H x W grid into at most four rectangles (interior, right strip, bottom
+    strip, corner) in which every window has the same valid extent.
+    Yields (h0, h1, w0, w1, rh, rw) where rh x rw is the valid extent of each window.
+    """
+    Hf, Wf = H - H % window_size, W - W % window_size
+    for h0, h1 in ((0, Hf), (Hf, H)):
+        if h1 == h0:
+            continue
+        rh = min(window_size, h1 - h0)
+        for w0, w1 in ((0, Wf), (Wf, W)):
+            if w1 == w0:
+                continue
+            rw = min(window_size, w1 - w0)
+            yield h0, h1, w0, w1, rh, rw
+
+
+def _region_views(x: torch.Tensor, windows: torch.Tensor, window_size: int, region):
+    """
+    Strided views of one region in both layouts, each [B, nh, nw, rh, rw, C]:
+    x is [B, H, W, C], windows is [B, Hp // ws, Wp // ws, ws, ws, C].
+    """
+    h0, h1, w0, w1, rh, rw = region
+    nh, nw = (h1 - h0) // rh, (w1 - w0) // rw
+    src = x[:, h0:h1, w0:w1].unflatten(2, (nw, rw)).unflatten(1, (nh, rh)).permute(0, 1, 3, 2, 4, 5)
+    hi, wi = h0 // window_size, w0 // window_size
+    dst = windows[:, hi:hi + nh, wi:wi + nw, :rh, :rw]
+    return src, dst
+
+
 def window_partition(x: torch.Tensor, window_size: int) -> Tuple[torch.Tensor, Tuple[int, int]]:
     """
     Partition into non-overlapping windows with padding if needed.
+    Windows are gathered region by region from strided views of x, so the padded
+    layout is written in a single copy (no F.pad + permute().contiguous()).
     Args:
         x (tensor): input tokens with [B, H, W, C].
         window_size (int): window size.
@@ -338,25 +396,40 @@ def window_partition(x: torch.Tensor, window_size: int) -> Tuple[torch.Tensor, T
 
     pad_h = (window_size - H % window_size) % window_size
     pad_w = (window_size - W % window_size) % window_size
-    if pad_h > 0 or pad_w > 0:
-        x = F.pad(x, (0, 0, 0, pad_w, 0, pad_h))
     Hp, Wp = H + pad_h, W + pad_w
 
-    x = x.view(B, Hp // window_size, window_size, Wp // window_size, window_size, C)
-    windows = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(-1, window_size, window_size, C)
-    return windows, (Hp, Wp)
+    windows = x.new_empty(B, Hp // window_size, Wp // window_size, window_size, window_size, C)
+    # padded tokens stay zero (as with F.pad): they still see the qkv bias as keys,
+    # so dropping them would change the attention output
+    if pad_h > 0:
+        windows[:, -1, :, window_size - pad_h:] = 0
+    if pad_w > 0:
+        windows[:, :, -1, :, window_size - pad_w:] = 0
+
+    for region in _window_regions(H, W, window_size):
+        src, dst = _region_views(x, windows, window_size, region)
+        dst.copy_(src)
+
+    return windows.view(-1, window_size, window_size, C), (Hp, Wp)
 
 
 def window_unpartition(
-    windows: torch.Tensor, window_size: int, pad_hw: Tuple[int, int], hw: Tuple[int, int]
+    windows: torch.Tensor,
+    window_size: int,
+    pad_hw: Tuple[int, int],
+    hw: Tuple[int, int],
+    residual: Optional[torch.Tensor] = None,
 ) -> torch.Tensor:
     """
     Window unpartition into original sequences and removing padding.
+    Only the valid part of every window is read back, so padding never gets copied.
     Args:
         windows (tensor): input tokens with [B * num_windows, window_size, window_size, C].
         window_size (int): window size.
         pad_hw (Tuple): padded height and width (Hp, Wp).
         hw (Tuple): original height and width (H, W) before padding.
+        residual (tensor or None): optional [B, H, W, C] tensor added to the output
+            in the same pass.
 
     Returns:
         x: unpartitioned sequences with [B, H, W, C].
@@ -364,11 +437,16 @@ def window_unpartition(
     Hp, Wp = pad_hw
     H, W = hw
     B = windows.shape[0] // (Hp * Wp // window_size // window_size)
-    x = windows.view(B, Hp // window_size, Wp // window_size, window_size, window_size, -1)
-    x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, Hp, Wp, -1)
-
-    if Hp > H or Wp > W:
-        x = x[:, :H, :W, :].contiguous()
+    windows = windows.view(B, Hp // window_size, Wp // window_size, window_size, window_size, -1)
+
+    x = windows.new_empty(B, H, W, windows.size(-1))
+    for region in _window_regions(H, W, window_size):
+        dst, src = _region_views(x, windows, window_size, region)
+        if residual is not None:
+            res, _ = _region_views(residual, windows, window_size, region)
+            torch.add(res, src, out=dst)
+        else:
+            dst.copy_(src)
     return x
 
 
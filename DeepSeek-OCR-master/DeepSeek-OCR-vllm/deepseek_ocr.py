@@ -1,6 +1,7 @@
 
 """Inference-only Deepseek-OCR model compatible with HuggingFace weights."""
-import math
+import atexit
+from functools import lru_cache
 from collections.abc import Iterable, Mapping, Sequence
 from typing import List, Literal, Optional, Set, Tuple, TypedDict, Union
 
@@ -8,8 +9,10 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange, repeat
+from PIL import Image
 from transformers import BatchFeature
 
+from vllm.attention import Attention
 from vllm.config import VllmConfig
 from vllm.model_executor import SamplingMetadata
 from vllm.model_executor.layers.quantization import QuantizationConfig
@@ -28,7 +31,8 @@ from vllm.transformers_utils.configs.deepseek_vl2 import (DeepseekVLV2Config,
                                                           MlpProjectorConfig,
                                                           VisionEncoderConfig)
 from process.image_process import (
-    DeepseekOCRProcessor, count_tiles)
+    DeepseekOCRProcessor, count_image_tokens, worst_case_image_size)
+from process.metrics import vision_encode_stats
 from vllm.transformers_utils.tokenizer import cached_tokenizer_from_config
 # from vllm.utils import is_list_of
 
@@ -40,9 +44,11 @@ from vllm.model_executor.models.utils import (AutoWeightsLoader, WeightsMapper,
 from deepencoder.sam_vary_sdpa import build_sam_vit_b
 from deepencoder.clip_sdpa import build_clip_l
 from deepencoder.build_linear import MlpProjector
+from deepencoder.profiler import EncoderProfiler
+from deepencoder.embedding_cache import ViewEmbeddingCache
 from addict import Dict
 # import time
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT
+from config import CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT, METRICS_VISION_ENCODE, PROFILE_ENCODER, VIEW_CACHE_MB
 # The image token id may be various
 _IMAGE_TOKEN = "<image>"
 
@@ -63,53 +69,21 @@ class DeepseekOCRProcessingInfo(BaseProcessingInfo):
                              image_width: int,
                              image_height: int,
                              cropping: bool = True) -> int:
-        hf_processor = self.get_hf_processor()
-
-
-        # image_size = hf_processor.image_size
-        # patch_size = hf_processor.patch_size
-        # downsample_ratio = hf_processor.downsample_ratio
-
-        image_size = IMAGE_SIZE
-        base_size = BASE_SIZE
-        patch_size = 16
-        downsample_ratio = 4
-
-        if CROP_MODE:
-            if image_width <= 640 and image_height <= 640:
-                crop_ratio = [1, 1]
-            else:
-                # images_crop_raw, crop_ratio = hf_processor.dynamic_preprocess(image)
-
-                # find the closest aspect ratio to the target
-                crop_ratio = count_tiles(image_width, image_height, image_size=IMAGE_SIZE)
-
-                # print('===========')
-                # print('crop_ratio ', crop_ratio)
-                # print('============')
-                
-            num_width_tiles, num_height_tiles = crop_ratio
-        else:
-            num_width_tiles = num_height_tiles = 1
-
-        h = w = math.ceil((base_size // patch_size) / downsample_ratio)
-
-        h2 = w2 = math.ceil((image_size // patch_size) / downsample_ratio)
-
-        global_views_tokens = h * (w + 1)
-        if num_width_tiles >1 or num_height_tiles>1:
-            local_views_tokens = (num_height_tiles * h2) * (num_width_tiles * w2 + 1)
-        else:
-            local_views_tokens = 0
-
-
-        return global_views_tokens + local_views_tokens + 1
+        # the tile plan follows config.CROP_MODE, as tokenize_with_images is called with it
+        return count_image_tokens(image_width, image_height, cropping=CROP_MODE)
 
     def get_image_size_with_most_features(self) -> ImageSize:
+        # the largest tile grid of MIN_CROPS..MAX_CROPS in the current mode, so profiling
+        # reserves memory for exactly the longest image prompt
+        width, height = worst_case_image_size()
+        return ImageSize(width=width, height=height)
+
 
-        if IMAGE_SIZE == 1024 and BASE_SIZE == 1280:
-            return ImageSize(width=1024*2, height=1024*2)
-        return ImageSize(width=640*2, height=640*2)
+@lru_cache(maxsize=4)
+def _dummy_image_inputs(width: int, height: int, num_images: int):
+    """preprocessed dummy images, built once however often the engine profiles"""
+    images = [Image.new('RGB', (width, height), color=(255, 255, 255)) for _ in range(num_images)]
+    return DeepseekOCRProcessor().tokenize_with_images(images=images, bos=True, eos=True, cropping=CROP_MODE)
 
 
 class DeepseekOCRDummyInputsBuilder(
@@ -134,10 +108,7 @@ class DeepseekOCRDummyInputsBuilder(
 
         if '<image>' in PROMPT:
             return {
-                "image":
-                DeepseekOCRProcessor().tokenize_with_images(images = self._get_dummy_images(width=max_image_size.width,
-                                    height=max_image_size.height,
-                                    num_images=num_images), bos=True, eos=True, cropping=CROP_MODE)
+                "image": _dummy_image_inputs(max_image_size.width, max_image_size.height, num_images)
             }
         else:
             return {
@@ -208,16 +179,9 @@ class DeepseekOCRMultiModalProcessor(
                 num_image_tokens = images.get_feature_size(item_idx)
             else:
 
-                
-                width = images[0][-1][0][0]
-                height = images[0][-1][0][1]
-
-                num_image_tokens = self.info.get_num_image_tokens(
-                    image_width=width,
-                    image_height=height,
-                    # flag = True,
-                    cropping=CROP_MODE,
-                )
+                # the count tokenize_with_images produced, so requests preprocessed
+                # with a different crop mode than CROP_MODE (page retries) still line up
+                num_image_tokens = images[0][-2][0]
             return [image_token_id] * num_image_tokens
 
         return [
@@ -290,6 +254,18 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
 
         n_embed = 1280
         self.projector =  MlpProjector(Dict(projector_type="linear", input_dim=2048, n_embed=n_embed))
+
+        # opt-in per-layer encoder profile, written at exit; attached once the engine is up,
+        # as its peak memory resets would corrupt vllm's startup memory profiling
+        self.encoder_profiler = None
+        if PROFILE_ENCODER:
+            self.encoder_profiler = EncoderProfiler()
+            atexit.register(self.encoder_profiler.dump, PROFILE_ENCODER)
+
+        # identical views (tiles or global) skip the encoders
+        self.view_cache = ViewEmbeddingCache(VIEW_CACHE_MB << 20) if VIEW_CACHE_MB else None
+        self._attention = () # a tuple, so the layer is not registered a second time as a submodule
+
         self.tile_tag = config.tile_tag
         self.global_view_pos = config.global_view_pos
     
@@ -338,7 +314,13 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         images_crop = kwargs.pop("images_crop", None)
 
 
-        if pixel_values is None or torch.sum(pixel_values).item() == 0:
+        if pixel_values is None:
+            return None
+        # a list when the batch mixes resolution modes (config.ADAPTIVE_MODE)
+        if isinstance(pixel_values, list):
+            if all(torch.sum(item).item() == 0 for item in pixel_values):
+                return None
+        elif torch.sum(pixel_values).item() == 0:
             return None
 
         if pixel_values is not None:
@@ -361,6 +343,27 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
     
 
 
+    def _encode_views(self, images):
+        """sam + clip + projector on a batch of views"""
+        features_1 = self.sam_model(images)
+        features_2 = self.vision_model(images, features_1)
+        return self.projector(torch.cat((features_2[:, 1:], features_1), dim=-1))
+
+    def _kv_cache_allocated(self):
+        """False during the engine's memory profiling run, which comes before the KV cache"""
+        if not self._attention:
+            self._attention = (next(module for module in self.language_model.modules() if isinstance(module, Attention)), )
+        return self._attention[0].kv_cache[0].numel() > 0
+
+    def _encode_views_cached(self, images):
+        if self.view_cache is None:
+            return self._encode_views(images)
+        if not self._kv_cache_allocated():
+            # the profiling dummy is identical white tiles, which would all hit
+            self.view_cache.reserve(images)
+            return self._encode_views(images)
+        return self.view_cache.encode(images, self._encode_views)
+
     def _pixel_values_to_embedding(
         self,
         pixel_values: torch.Tensor,
@@ -388,23 +391,16 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                 image_ori = pixel_values[jdx]
                 crop_shape = images_spatial_crop[jdx][0]
 
+                if METRICS_VISION_ENCODE:
+                    encode_start = vision_encode_stats.start()
+
                 if torch.sum(patches).item() != 0:  # if all values = 0, no crop
                     # P, C, H, W = patches.shape
                     # crop_flag = 1
-                    local_features_1 = self.sam_model(patches)
-                    #TODO del patches 
-                    # torch.compiler.cudagraph_mark_step_begin()
-                    local_features_2 = self.vision_model(patches, local_features_1)  
-
-
-                    local_features = torch.cat((local_features_2[:, 1:], local_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    local_features = self.projector(local_features)
-
+                    # only tiles not in the view cache go through the encoders
+                    local_features = self._encode_views_cached(patches)
 
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
+                    global_features = self._encode_views_cached(image_ori)
 
                     if PRINT_NUM_VIS_TOKENS:
                         print('=====================')
@@ -438,10 +434,7 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                     global_local_features = torch.cat([local_features, global_features, self.view_seperator[None, :]], dim=0)
                 
                 else:
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
+                    global_features = self._encode_views_cached(image_ori)
 
                     if PRINT_NUM_VIS_TOKENS:
                         print('=====================')
@@ -462,6 +455,9 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
 
                     global_local_features = torch.cat([global_features, self.view_seperator[None, :]], dim=0)
 
+                if METRICS_VISION_ENCODE:
+                    vision_encode_stats.stop(encode_start, global_local_features.shape[0])
+
                 images_in_this_batch.append(global_local_features)
 
         return images_in_this_batch
@@ -471,8 +467,15 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         
 
         # image_input: [pixel_values, images_crop, images_spatial_crop]
+
+        if self.encoder_profiler is not None and not self.encoder_profiler.attached and self._kv_cache_allocated():
+            self.encoder_profiler.attach(self.sam_model, self.vision_model, self.projector)
     
-        pixel_values = image_input[0].to(torch.bfloat16)
+        pixel_values = image_input[0]
+        if isinstance(pixel_values, list):
+            pixel_values = [item.to(torch.bfloat16) for item in pixel_values]
+        else:
+            pixel_values = pixel_values.to(torch.bfloat16)
         # print(image_input[1][0].shape)
         # print(type(image_input[1]))
         # exit()
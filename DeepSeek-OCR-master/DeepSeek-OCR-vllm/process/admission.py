@@ -0,0 +1,91 @@
+import asyncio
+import math
+from collections import deque
+from contextlib import asynccontextmanager
+
+def kv_cache_tokens(engine):
+    """KV cache capacity in tokens of a (V0) AsyncLLMEngine, as sized by its memory profiling"""
+    cache_config = engine.engine.cache_config
+    return cache_config.num_gpu_blocks * cache_config.block_size
+
+
+def plan_max_tokens(cost, headroom=4.0, min_tokens=2048, max_tokens=8192):
+    """decode budget of a page from its PageCost: `headroom` x its predicted output length, within [min_tokens, max_tokens]"""
+    return int(min(max_tokens, max(min_tokens, headroom * cost.decode_tokens)))
+
+
+class KVAdmission:
+    """
+    Admission control on KV cache blocks instead of a fixed number of sequences.
+
+    Every request reserves the blocks it can grow to: its exact prompt length (text and
+    vision tokens, from the tokenized request) plus its max_tokens. Requests are admitted
+    in arrival order while the reservations fit in `budget_tokens`, so many short pages
+    run side by side and a few large ones never oversubscribe the cache. A request
+    larger than the whole budget runs alone.
+
+    Args:
+        budget_tokens: KV cache capacity in tokens, see kv_cache_tokens.
+        block_size: the engine's block size; reservations are rounded up to blocks.
+        plan_max_tokens: optional PageCost -> max_tokens; requests given a cost get
+            their own SamplingParams with it. The cost is estimated off the event
+            loop (see page_order.estimate_cost), plan() only does arithmetic. Pages that hit it without eos are what the retry
+            policy is for. Without it the max_tokens of the sampling params is reserved.
+        budget_fraction: share of the cache admission may fill; the engine keeps a
+            watermark of free blocks.
+    """
+
+    def __init__(self, budget_tokens, block_size, plan_max_tokens=None, budget_fraction=0.95):
+        self.budget = int(budget_tokens * budget_fraction)
+        self.block_size = block_size
+        self.plan_max_tokens = plan_max_tokens
+        self.in_use = 0
+        self.running = 0
+        self.waiting = deque()
+        self.condition = asyncio.Condition()
+        self._params = {} # (id(base params), max_tokens) -> (base params, SamplingParams)
+
+    def plan(self, request, sampling_params, cost=None):
+        """(sampling params, reserved tokens) of an engine request from tokenize_with_images and its PageCost"""
+        # input_ids of tokenize_with_images are [1, L]
+        prompt_tokens = request['multi_modal_data']['image'][0][0].shape[-1]
+        max_tokens = sampling_params.max_tokens
+        if cost is not None and self.plan_max_tokens is not None:
+            max_tokens = min(max_tokens, math.ceil(self.plan_max_tokens(cost) / self.block_size) * self.block_size)
+            sampling_params = self._with_max_tokens(sampling_params, max_tokens)
+        reserved = math.ceil((prompt_tokens + max_tokens) / self.block_size) * self.block_size
+        return sampling_params, reserved
+
+    def _with_max_tokens(self, sampling_params, max_tokens):
+        if max_tokens == sampling_params.max_tokens:
+            return sampling_params
+        key = (id(sampling_params), max_tokens)
+        cached = self._params.get(key)
+        # the base params are kept alive with the copy, so their id is not reused
+        if cached is None:
+            params = sampling_params.clone()
+            params.max_tokens = max_tokens
+            cached = self._params[key] = (sampling_params, params)
+        return cached[1]
+
+    @asynccontextmanager
+    async def admit(self, tokens):
+        ticket = object()
+        async with self.condition:
+            self.waiting.append(ticket)
+            try:
+                await self.condition.wait_for(
+                    lambda: self.waiting[0] is ticket and (self.running == 0 or self.in_use + tokens <= self.budget))
+            finally:
+                self.waiting.remove(ticket)
+                # the next in line may fit as well
+                self.condition.notify_all()
+            self.in_use += tokens
+            self.running += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.in_use -= tokens
+                self.running -= 1
+                self.condition.notify_all()
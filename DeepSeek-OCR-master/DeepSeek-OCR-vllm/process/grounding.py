@@ -0,0 +1,319 @@
+import re
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageDraw, ImageFont
+
+
+_NUMBER = re.compile(r'-?\d+(?:\.\d+)?')
+_COORDS_CHARS = re.compile(r'[\d\s,.\[\]()-]*')
+_RUNS = re.compile(r'\n+|[^\n]+')
+_FORMULA = re.compile(r'\\\[(.*?)\\\]')
+_FORMULA_TAG = re.compile(r'\\quad\s*\([^)]*\)')
+
+REF_OPEN = '<|ref|>'
+REF_CLOSE_DET_OPEN = '<|/ref|><|det|>'
+DET_CLOSE = '<|/det|>'
+_TAG_OVERLAP = max(len(REF_OPEN), len(REF_CLOSE_DET_OPEN), len(DET_CLOSE)) - 1
+
+# markdown fix-ups applied to the text between grounding blocks
+MARKDOWN_REPLACEMENTS = {'\\coloneqq': ':=', '\\eqqcolon': '=:'}
+
+_font = None
+
+
+def _get_font():
+    global _font
+    if _font is None:
+        _font = ImageFont.load_default()
+    return _font
+
+
+def parse_boxes(coords_text):
+    """
+    '[[x1, y1, x2, y2], ...]' -> [(x1, y1, x2, y2), ...] without eval(); None if malformed.
+    Coordinates are on the model's 0..999 grid.
+    """
+    if not _COORDS_CHARS.fullmatch(coords_text):
+        return None
+    numbers = _NUMBER.findall(coords_text)
+    if not numbers or len(numbers) % 4:
+        return None
+    values = [float(number) for number in numbers]
+    return [tuple(values[i:i + 4]) for i in range(0, len(values), 4)]
+
+
+def label_color(label):
+    """stable color per label, so the same block type looks the same on every page"""
+    code = zlib.crc32(label.encode('utf-8'))
+    return (code & 0xFF) % 200, (code >> 8 & 0xFF) % 200, (code >> 16) & 0xFF
+
+
+def scale_box(box, width, height):
+    x1, y1, x2, y2 = box
+    return int(x1 / 999 * width), int(y1 / 999 * height), int(x2 / 999 * width), int(y2 / 999 * height)
+
+
+def _clean_formula(match):
+    return r'\[' + _FORMULA_TAG.sub('', match.group(1)).strip() + r'\]'
+
+
+class GroundingBlock:
+    """
+    One `<|ref|>label<|/ref|><|det|>[[...]]<|/det|>` block and the markdown that follows it,
+    text == markdown[start:end] once the block is complete. `boxes` is None if the
+    coordinates are malformed, `figure` the image link that replaced an `image` block.
+    """
+
+    __slots__ = ('label', 'boxes', 'start', 'end', 'figure', 'text', 'first_part')
+
+    def __init__(self, label, boxes, start, figure=None):
+        self.label = label
+        self.boxes = boxes
+        self.start = start
+        self.end = start
+        self.figure = figure
+        self.text = ''
+        self.first_part = 0
+
+
+class GroundingParser:
+    """
+    Single-pass parser for the grounding output.
+
+    Text is fed as it is generated (or all at once) and scanned once: every block is
+    cut out as it closes, the text between blocks goes through `replacements` and the
+    newline collapsing into the markdown, and the boxes are parsed on the spot. feed()
+    and finish() return the blocks whose markdown became complete.
+
+    Args:
+        image_link: idx -> link target for the idx-th `image` block, inserted as
+            `![](target)`; None drops image blocks like every other block.
+        replacements: str -> str fix-ups applied to the text between blocks.
+        collapse_newlines: turn runs of 3+ newlines into a blank line, including
+            the runs left behind by removed blocks.
+        clean_formulas: drop `\\quad (n)` equation numbers inside `\\[ ... \\]`.
+    """
+
+    def __init__(self, image_link=None, replacements=MARKDOWN_REPLACEMENTS, collapse_newlines=True,
+                 clean_formulas=False):
+        self.image_link = image_link
+        self.replacements = replacements
+        self.collapse_newlines = collapse_newlines
+        self.clean_formulas = clean_formulas
+
+        self.blocks = []
+        self.figures = []
+        self._parts = []
+        self._length = 0 # markdown length so far
+        self._newlines = 0 # newlines at the end of the markdown so far
+        self._chunks = [] # text after the last block, not yet in the markdown (the buffer)
+        self._tail = '' # the last characters fed, where a tag split across chunks starts
+        self._in_block = False
+        self._det = -1 # buffer offset of the <|/ref|><|det|> of the open block
+        self._scan = 0 # where to resume searching the buffer, so nothing is scanned twice
+        self._finished = False
+
+    @property
+    def markdown(self):
+        return ''.join(self._parts)
+
+    def _next_tag(self):
+        if not self._in_block:
+            return REF_OPEN
+        return REF_CLOSE_DET_OPEN if self._det < 0 else DET_CLOSE
+
+    def feed(self, text):
+        completed = []
+        if not text:
+            return completed
+        self._chunks.append(text)
+        # the tag that moves the parser on can only end in the new text; until it does, the
+        # chunks are kept as they are, so streamed tokens are not copied into a growing buffer
+        window = self._tail + text
+        self._tail = window[-_TAG_OVERLAP:]
+        if self._next_tag() not in window:
+            return completed
+
+        buffer = ''.join(self._chunks) if len(self._chunks) > 1 else text
+        pos = 0 # start of the buffer not consumed yet
+        while True:
+            if not self._in_block:
+                start = buffer.find(REF_OPEN, self._scan)
+                if start < 0:
+                    # a tag may be split across chunks
+                    self._scan = max(pos, len(buffer) - len(REF_OPEN) + 1)
+                    break
+                self._emit_text(buffer[pos:start])
+                pos = start
+                self._in_block = True
+                self._det = -1
+                self._scan = start + len(REF_OPEN)
+
+            if self._det < 0:
+                det = buffer.find(REF_CLOSE_DET_OPEN, self._scan)
+                if det < 0:
+                    self._scan = max(self._scan, len(buffer) - len(REF_CLOSE_DET_OPEN) + 1)
+                    break
+                self._det = det
+                self._scan = det + len(REF_CLOSE_DET_OPEN)
+
+            end = buffer.find(DET_CLOSE, self._scan)
+            if end < 0:
+                self._scan = max(self._scan, len(buffer) - len(DET_CLOSE) + 1)
+                break
+
+            if self.blocks:
+                completed.append(self._close_block())
+            self._open_block(buffer[pos + len(REF_OPEN):self._det], buffer[self._det + len(REF_CLOSE_DET_OPEN):end])
+            pos = end + len(DET_CLOSE)
+            self._in_block = False
+            self._scan = pos
+
+        # only what follows the last tag is copied, offsets move with it
+        self._chunks = [buffer[pos:]] if pos < len(buffer) else []
+        self._scan -= pos
+        if self._det >= 0:
+            self._det -= pos
+        return completed
+
+    def finish(self):
+        """flushes the trailing text (or an unterminated block, kept verbatim) and closes the last block"""
+        if self._finished:
+            return []
+        self._finished = True
+        self._emit_text(''.join(self._chunks))
+        self._chunks = []
+        return [self._close_block()] if self.blocks else []
+
+    def _open_block(self, label, coords):
+        figure = None
+        if label == 'image' and self.image_link is not None:
+            figure = self.image_link(len(self.figures))
+            self.figures.append(figure)
+        block = GroundingBlock(label, parse_boxes(coords), self._length, figure)
+        block.first_part = len(self._parts)
+        self.blocks.append(block)
+        if figure is not None:
+            self._append(f'![]({figure})\n')
+
+    def _close_block(self):
+        block = self.blocks[-1]
+        block.end = self._length
+        block.text = ''.join(self._parts[block.first_part:])
+        return block
+
+    def _emit_text(self, text):
+        if not text:
+            return
+        if self.clean_formulas and '\\[' in text:
+            text = _FORMULA.sub(_clean_formula, text)
+        for old, new in self.replacements.items():
+            if old in text:
+                text = text.replace(old, new)
+        self._append(text)
+
+    def _append(self, text):
+        if not self.collapse_newlines:
+            self._parts.append(text)
+            self._length += len(text)
+            return
+        for run in _RUNS.finditer(text):
+            piece = run.group()
+            if piece[0] == '\n':
+                # the run continues the newlines already written, at most two in a row
+                keep = max(0, min(self._newlines + len(piece), 2) - self._newlines)
+                self._newlines += keep
+                piece = piece[:keep]
+            else:
+                self._newlines = 0
+            if piece:
+                self._parts.append(piece)
+                self._length += len(piece)
+
+
+def parse_grounding(text, **kwargs):
+    """parses a complete output in one pass; returns the finished GroundingParser"""
+    parser = GroundingParser(**kwargs)
+    parser.feed(text)
+    parser.finish()
+    return parser
+
+
+class FigureCropWriter:
+    """
+    crops `image` regions and saves them on a background pool, off the result-assembly path;
+    submit() blocks once `max_pending` crops are queued, so pages are not kept alive unboundedly
+    """
+
+    def __init__(self, num_workers=4, max_pending=64):
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def _save(self, image, box, path):
+        try:
+            image.crop(box).save(path)
+        except Exception as e:
+            print(e)
+        finally:
+            self.slots.release()
+
+    def submit(self, image, box, path):
+        self.slots.acquire()
+        self.executor.submit(self._save, image, box, path)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def draw_layout(image, blocks, crop_writer=None, crop_prefix='', max_side=None):
+    """
+    Draws the boxes of the parsed grounding `blocks` onto a preview of
+    `image` whose longer side is at most `max_side`, and hands every `image` region to
+    `crop_writer` as f'{crop_prefix}{idx}.jpg', cropped from the full-resolution page.
+    Returns the annotated preview.
+    """
+    width, height = image.size
+    if max_side and max(width, height) > max_side:
+        scale = max_side / max(width, height)
+        preview = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.BILINEAR)
+    else:
+        preview = image.copy()
+    if preview.mode != 'RGB':
+        preview = preview.convert('RGB')
+    preview_width, preview_height = preview.size
+
+    # RGBA draw blends the translucent fills straight into the preview, no overlay image
+    draw = ImageDraw.Draw(preview, 'RGBA')
+    font = _get_font()
+
+    img_idx = 0
+    for block in blocks:
+        label_type = block.label
+        boxes = block.boxes
+        if boxes is None:
+            continue
+
+        color = label_color(label_type)
+        for box in boxes:
+            if label_type == 'image':
+                if crop_writer is not None:
+                    crop_writer.submit(image, scale_box(box, width, height), f'{crop_prefix}{img_idx}.jpg')
+                img_idx += 1
+
+            x1, y1, x2, y2 = scale_box(box, preview_width, preview_height)
+            if x2 < x1 or y2 < y1:
+                continue
+
+            draw.rectangle([x1, y1, x2, y2], fill=color + (20, ))
+            draw.rectangle([x1, y1, x2, y2], outline=color, width=4 if label_type == 'title' else 2)
+
+            text_x = x1
+            text_y = max(0, y1 - 15)
+            text_bbox = draw.textbbox((0, 0), label_type, font=font)
+            draw.rectangle([text_x, text_y, text_x + text_bbox[2] - text_bbox[0], text_y + text_bbox[3] - text_bbox[1]],
+                           fill=(255, 255, 255))
+            draw.text((text_x, text_y), label_type, font=font, fill=color)
+
+    return preview
@@ -1,5 +1,5 @@
 import math
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import torch
 import torchvision.transforms as T
@@ -42,6 +42,80 @@ def count_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, i
     return target_aspect_ratio
 
 
+def count_image_tokens(image_width, image_height, cropping=CROP_MODE, patch_size=16, downsample_ratio=4,
+                       base_size=BASE_SIZE, image_size=IMAGE_SIZE):
+    """<image> tokens tokenize_with_images emits for an image of this size: the global view plus the tile grid"""
+    if cropping and (image_width > 640 or image_height > 640):
+        num_width_tiles, num_height_tiles = count_tiles(image_width, image_height, image_size=image_size)
+    else:
+        num_width_tiles = num_height_tiles = 1
+
+    h = w = math.ceil((base_size // patch_size) / downsample_ratio)
+    h2 = w2 = math.ceil((image_size // patch_size) / downsample_ratio)
+
+    global_views_tokens = h * (w + 1)
+    if num_width_tiles > 1 or num_height_tiles > 1:
+        local_views_tokens = (num_height_tiles * h2) * (num_width_tiles * w2 + 1)
+    else:
+        local_views_tokens = 0
+
+    return global_views_tokens + local_views_tokens + 1
+
+
+def worst_case_image_size(cropping=CROP_MODE, min_num=MIN_CROPS, max_num=MAX_CROPS):
+    """
+    (width, height) of an image with the most <image> tokens in the current mode: the tile grid
+    with the most rows (one newline token per row on top of the tiles) that count_tiles can
+    pick, at exactly its tile size. Without cropping every image has the same count.
+    """
+    if not cropping:
+        return BASE_SIZE, BASE_SIZE
+    best_size, best_tokens = (BASE_SIZE, BASE_SIZE), count_image_tokens(BASE_SIZE, BASE_SIZE, cropping=cropping)
+    grids = set((i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1)
+                if min_num <= i * j <= max_num)
+    for grid in sorted(grids):
+        width, height = IMAGE_SIZE * grid[0], IMAGE_SIZE * grid[1]
+        if count_tiles(width, height, min_num, max_num, image_size=IMAGE_SIZE) != grid:
+            continue
+        tokens = count_image_tokens(width, height, cropping=cropping)
+        if tokens > best_tokens:
+            best_size, best_tokens = (width, height), tokens
+    return best_size
+
+
+def plan_target_size(orig_width, orig_height, cropping=CROP_MODE):
+    """
+    Smallest (width, height) with the input aspect ratio that covers every view the
+    model takes of the image: the local tile grid (when cropping) and the global view.
+    An image of at most 640 x 640 is not tiled by tokenize_with_images, so it keeps its
+    size: scaling it up to a tile grid would change what the model sees.
+    """
+    if cropping and orig_width <= 640 and orig_height <= 640:
+        return math.ceil(orig_width), math.ceil(orig_height)
+    if cropping:
+        num_width_tiles, num_height_tiles = count_tiles(orig_width, orig_height, image_size=IMAGE_SIZE)
+        scale = max(IMAGE_SIZE * num_width_tiles / orig_width, IMAGE_SIZE * num_height_tiles / orig_height,
+                    BASE_SIZE / max(orig_width, orig_height))
+    elif IMAGE_SIZE <= 640:
+        # tokenize_with_images stretches the image to image_size x image_size
+        scale = IMAGE_SIZE / min(orig_width, orig_height)
+    else:
+        scale = BASE_SIZE / max(orig_width, orig_height)
+
+    return math.ceil(orig_width * scale), math.ceil(orig_height * scale)
+
+
+def plan_render_dpi(page_width, page_height, oversample=1.0, reference_dpi=144, cropping=CROP_MODE):
+    """
+    dpi at which a pdf page box (in points) rasterizes to the size plan_target_size asks for.
+    The tile grid is chosen on the page as rendered at `reference_dpi`, so tiling matches
+    the fixed-dpi renderer; `oversample` > 1 renders above the planned size.
+    """
+    reference_zoom = reference_dpi / 72.0
+    target_width, _ = plan_target_size(page_width * reference_zoom, page_height * reference_zoom, cropping=cropping)
+    return 72.0 * target_width / page_width * oversample
+
+
 def dynamic_preprocess(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
     orig_width, orig_height = image.size
     aspect_ratio = orig_width / orig_height
@@ -63,8 +137,11 @@ def dynamic_preprocess(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=6
     target_height = image_size * target_aspect_ratio[1]
     blocks = target_aspect_ratio[0] * target_aspect_ratio[1]
 
-    # resize the image
-    resized_img = image.resize((target_width, target_height))
+    # resize the image (pages rendered at the planned size may already match)
+    if image.size != (target_width, target_height):
+        resized_img = image.resize((target_width, target_height))
+    else:
+        resized_img = image
     processed_images = []
     for i in range(blocks):
         box = (
@@ -334,11 +411,19 @@ class DeepseekOCRProcessor(ProcessorMixin):
         bos: bool = True,
         eos: bool = True,
         cropping: bool = True,
+        prompt: Optional[str] = None,
+        mode: Optional[Tuple[int, int, bool]] = None,
     ):
-        """Tokenize text with <image> tags."""
+        """
+        Tokenize text with <image> tags; `prompt` defaults to config.PROMPT, `mode` is a
+        (base_size, image_size, crop_mode) overriding the config mode and `cropping`.
+        """
+        base_size, image_size = self.base_size, self.image_size
+        if mode is not None:
+            base_size, image_size, cropping = mode
 
         # print(conversation)
-        conversation = PROMPT
+        conversation = PROMPT if prompt is None else prompt
         assert conversation.count(self.image_token) == len(images)
         text_splits = conversation.split(self.image_token)
         images_list, images_crop_list, images_seq_mask, images_spatial_crop = [], [], [], []
@@ -368,7 +453,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
                     # best_width, best_height = select_best_resolution(image.size, self.candidate_resolutions)
                     # print('image ', image.size)
                     # print('open_size:', image.size)
-                    images_crop_raw, crop_ratio = dynamic_preprocess(image, image_size=IMAGE_SIZE)
+                    images_crop_raw, crop_ratio = dynamic_preprocess(image, image_size=image_size)
                     # print('crop_ratio: ', crop_ratio)
                 else:
                     # best_width, best_height = self.image_size, self.image_size
@@ -379,11 +464,11 @@ class DeepseekOCRProcessor(ProcessorMixin):
             """process the global view"""
 
             # if cropping
-            if self.image_size <= 640 and not cropping:
+            if image_size <= 640 and not cropping:
                 # print('directly resize')
-                image = image.resize((self.image_size, self.image_size))
+                image = image.resize((image_size, image_size))
 
-            global_view = ImageOps.pad(image, (self.base_size, self.base_size),
+            global_view = ImageOps.pad(image, (base_size, base_size),
                                     color=tuple(int(x * 255) for x in self.image_transform.mean))
             images_list.append(self.image_transform(global_view))
 
@@ -421,8 +506,8 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
             # """add image tokens"""
             """add image tokens"""
-            num_queries = math.ceil((self.image_size // self.patch_size) / self.downsample_ratio)
-            num_queries_base = math.ceil((self.base_size // self.patch_size) / self.downsample_ratio)
+            num_queries = math.ceil((image_size // self.patch_size) / self.downsample_ratio)
+            num_queries_base = math.ceil((base_size // self.patch_size) / self.downsample_ratio)
 
 
             tokenized_image = ([self.image_token_id] * num_queries_base + [self.image_token_id]) * num_queries_base
@@ -482,16 +567,16 @@ class DeepseekOCRProcessor(ProcessorMixin):
             images_seq_mask = images_seq_mask[:-1]
 
         if len(images_list) == 0:
-            pixel_values = torch.zeros((1, 3, self.base_size, self.base_size))
+            pixel_values = torch.zeros((1, 3, base_size, base_size))
             images_spatial_crop = torch.zeros((1, 1), dtype=torch.long)
-            images_crop = torch.zeros((1, 3, self.image_size, self.image_size)).unsqueeze(0)
+            images_crop = torch.zeros((1, 3, image_size, image_size)).unsqueeze(0)
         else:
             pixel_values = torch.stack(images_list, dim=0)
             images_spatial_crop = torch.tensor(images_spatial_crop, dtype=torch.long)
             if images_crop_list:
                 images_crop = torch.stack(images_crop_list, dim=0).unsqueeze(0)
             else:
-                images_crop = torch.zeros((1, 3, self.image_size, self.image_size)).unsqueeze(0)
+                images_crop = torch.zeros((1, 3, image_size, image_size)).unsqueeze(0)
 
         input_ids = input_ids.unsqueeze(0)
 
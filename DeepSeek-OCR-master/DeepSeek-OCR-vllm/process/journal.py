@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+import threading
+from types import SimpleNamespace
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """sha256 of the file contents, so a renamed or copied document still hits the journal"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as afile:
+        for chunk in iter(lambda: afile.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class StoredOutput:
+    """stands in for a vllm RequestOutput that did not come from the engine (journal, text layer)"""
+
+    def __init__(self, text, finish_reason):
+        self.outputs = [SimpleNamespace(text=text, finish_reason=finish_reason)]
+        self.finished = True
+
+
+class PageJournal:
+    """
+    Append-only jsonl journal of completed pages, keyed by (document hash, page index).
+
+    Every line holds the raw model text and finish reason of one page. Entries written
+    under a different `fingerprint` (prompt, resolution mode, sampling and retry settings)
+    are ignored, so changing the settings never replays stale results.
+    """
+
+    def __init__(self, path, fingerprint=''):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.entries = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, 'rb') as afile:
+                data = afile.read()
+            # a crashed run can leave a torn last line; it is cut off, or the next entry
+            # would be appended to it and be unreadable on every later resume
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                with open(path, 'r+b') as afile:
+                    afile.truncate(end)
+            for line in data[:end].decode('utf-8').split('\n'):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry.get('fingerprint', '') == fingerprint:
+                    self.entries[(entry['doc'], entry['page'])] = entry
+
+        self.afile = open(path, 'a', encoding='utf-8')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, doc_hash, page_idx):
+        entry = self.entries.get((doc_hash, page_idx))
+        if entry is None:
+            return None
+        return StoredOutput(entry['text'], entry['finish_reason'])
+
+    def append(self, doc_hash, page_idx, text, finish_reason):
+        entry = {
+            'doc': doc_hash,
+            'page': page_idx,
+            'fingerprint': self.fingerprint,
+            'finish_reason': finish_reason,
+            'text': text,
+        }
+        with self.lock:
+            self.entries[(doc_hash, page_idx)] = entry
+            self.afile.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.afile.flush()
+
+    def close(self):
+        self.afile.close()
@@ -0,0 +1,118 @@
+import io
+from collections import deque
+
+from PIL import Image
+
+
+def encode_page(img, quality=95, max_side=None):
+    """
+    overlay page -> (jpeg bytes, width, height, page_width, page_height); the jpeg is optionally
+    downscaled so its longer side is max_side, the page keeps the size of the original
+    """
+    page_width, page_height = img.size
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if max_side and max(img.size) > max_side:
+        scale = max_side / max(img.size)
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.BILINEAR)
+
+    img_buffer = io.BytesIO()
+    img.save(img_buffer, format='JPEG', quality=quality)
+    return img_buffer.getvalue(), img.width, img.height, page_width, page_height
+
+
+class LayoutPdfWriter:
+    """
+    Incremental image-only pdf writer for the layout overlays.
+
+    Pages are jpeg-encoded on `executor` as they arrive and appended to the file in
+    order as soon as they are encoded; each page is embedded as-is (DCTDecode), so
+    memory holds at most `max_pending` pages no matter how long the document is.
+    The page tree and xref are written by close().
+    """
+
+    # matches img2pdf's default for images without dpi metadata
+    DPI = 96
+
+    def __init__(self, path, executor, quality=95, max_side=None, max_pending=8):
+        self.path = path
+        self.executor = executor
+        self.quality = quality
+        self.max_side = max_side
+        self.max_pending = max_pending
+
+        self.afile = None
+        self.offsets = [] # byte offset of every object, object n at index n - 1
+        self.page_ids = []
+        self.pending = deque()
+
+    def add(self, img):
+        self.pending.append(self.executor.submit(encode_page, img, self.quality, self.max_side))
+        # append whatever is already encoded, block only when too many pages are queued
+        while self.pending and (self.pending[0].done() or len(self.pending) > self.max_pending):
+            self._append_page(*self.pending.popleft().result())
+
+    def close(self):
+        while self.pending:
+            self._append_page(*self.pending.popleft().result())
+        if self.afile is None:
+            return
+
+        # objects 1 (catalog) and 2 (page tree) were reserved in _open
+        kids = ' '.join(f'{page_id} 0 R' for page_id in self.page_ids)
+        self._write_object(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+        self._write_object(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>'.encode())
+
+        xref_offset = self.afile.tell()
+        self.afile.write(f'xref\n0 {len(self.offsets) + 1}\n'.encode())
+        self.afile.write(b'0000000000 65535 f \n')
+        for offset in self.offsets:
+            self.afile.write(f'{offset:010d} 00000 n \n'.encode())
+        self.afile.write(f'trailer\n<< /Size {len(self.offsets) + 1} /Root 1 0 R >>\n'.encode())
+        self.afile.write(f'startxref\n{xref_offset}\n%%EOF\n'.encode())
+
+        self.afile.close()
+        self.afile = None
+
+    def _open(self):
+        self.afile = open(self.path, 'wb')
+        self.afile.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        self.offsets = [0, 0]
+
+    def _new_id(self):
+        self.offsets.append(0)
+        return len(self.offsets)
+
+    def _write_object(self, obj_id, body, stream=None):
+        self.offsets[obj_id - 1] = self.afile.tell()
+        self.afile.write(f'{obj_id} 0 obj\n'.encode())
+        self.afile.write(body)
+        if stream is not None:
+            self.afile.write(b'\nstream\n')
+            self.afile.write(stream)
+            self.afile.write(b'\nendstream')
+        self.afile.write(b'\nendobj\n')
+
+    def _append_page(self, jpeg_bytes, width, height, page_width, page_height):
+        if self.afile is None:
+            self._open()
+
+        page_width = page_width * 72 / self.DPI
+        page_height = page_height * 72 / self.DPI
+
+        image_id, content_id, page_id = self._new_id(), self._new_id(), self._new_id()
+
+        self._write_object(image_id, (
+            f'<< /Type /XObject /Subtype /Image /Width {width} /Height {height} '
+            f'/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode /Length {len(jpeg_bytes)} >>'
+        ).encode(), jpeg_bytes)
+
+        content = f'q {page_width:.4f} 0 0 {page_height:.4f} 0 0 cm /Im0 Do Q'.encode()
+        self._write_object(content_id, f'<< /Length {len(content)} >>'.encode(), content)
+
+        self._write_object(page_id, (
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width:.4f} {page_height:.4f}] '
+            f'/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>'
+        ).encode())
+        self.page_ids.append(page_id)
+        self.afile.flush()
@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+COLUMNS = ('doc', 'page', 'block', 'label', 'x1', 'y1', 'x2', 'y2', 'start', 'end')
+
+
+class LayoutTableWriter:
+    """
+    Columnar table of the grounding blocks, one row per box.
+
+    doc / label are dictionary-encoded strings, x1..y2 the box normalized to 0..1 (NaN for
+    malformed coordinates), start / end the character span of the block in the document's
+    .mmd file. Written as parquet, one row group every `row_group_size` rows, when pyarrow
+    is installed; otherwise as a compressed .npz next to `path` on close().
+    """
+
+    def __init__(self, path, row_group_size=1 << 16):
+        self.row_group_size = row_group_size
+        self.use_parquet = pq is not None
+        self.path = path if self.use_parquet else os.path.splitext(path)[0] + '.npz'
+        self.parquet_writer = None
+        self.columns = {name: [] for name in COLUMNS}
+        # npz fallback: everything is kept until close()
+        self.chunks = {name: [] for name in COLUMNS}
+
+    def add_page(self, doc, page_idx, blocks, offset=0):
+        """`blocks` of one page from GroundingParser; `offset` is where the page starts in the .mmd"""
+        columns = self.columns
+        for block_idx, block in enumerate(blocks):
+            for box in block.boxes or [(float('nan'), ) * 4]:
+                columns['doc'].append(doc)
+                columns['page'].append(page_idx)
+                columns['block'].append(block_idx)
+                columns['label'].append(block.label)
+                for name, value in zip(('x1', 'y1', 'x2', 'y2'), box):
+                    columns[name].append(value / 999)
+                columns['start'].append(offset + block.start)
+                columns['end'].append(offset + block.end)
+        if len(columns['doc']) >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if not self.columns['doc']:
+            return
+        columns = self.columns
+        self.columns = {name: [] for name in COLUMNS}
+
+        if not self.use_parquet:
+            for name in COLUMNS:
+                self.chunks[name].extend(columns[name])
+            return
+
+        table = pa.table({
+            'doc': pa.array(columns['doc'], pa.string()).dictionary_encode(),
+            'page': pa.array(columns['page'], pa.int32()),
+            'block': pa.array(columns['block'], pa.int32()),
+            'label': pa.array(columns['label'], pa.string()).dictionary_encode(),
+            **{name: pa.array(columns[name], pa.float32()) for name in ('x1', 'y1', 'x2', 'y2')},
+            'start': pa.array(columns['start'], pa.int64()),
+            'end': pa.array(columns['end'], pa.int64()),
+        })
+        if self.parquet_writer is None:
+            self.parquet_writer = pq.ParquetWriter(self.path, table.schema, compression='zstd')
+        self.parquet_writer.write_table(table)
+
+    def close(self):
+        self._flush()
+        if self.use_parquet:
+            if self.parquet_writer is not None:
+                self.parquet_writer.close()
+            return
+
+        chunks = self.chunks
+        docs, doc_codes = np.unique(np.array(chunks['doc'], dtype=str), return_inverse=True)
+        labels, label_codes = np.unique(np.array(chunks['label'], dtype=str), return_inverse=True)
+        np.savez_compressed(
+            self.path,
+            docs=docs, doc=doc_codes.astype(np.int32),
+            labels=labels, label=label_codes.astype(np.int32),
+            page=np.array(chunks['page'], dtype=np.int32),
+            block=np.array(chunks['block'], dtype=np.int32),
+            **{name: np.array(chunks[name], dtype=np.float32) for name in ('x1', 'y1', 'x2', 'y2')},
+            start=np.array(chunks['start'], dtype=np.int64),
+            end=np.array(chunks['end'], dtype=np.int64),
+        )
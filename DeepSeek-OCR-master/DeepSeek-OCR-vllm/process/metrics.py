@@ -0,0 +1,209 @@
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import torch
+
+
+# per-page stages, in pipeline order; queue / prefill / ttft / decode come from the engine's RequestMetrics
+STAGES = ('render', 'preprocess', 'queue', 'prefill', 'ttft', 'decode', 'postprocess')
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Histogram:
+    """cumulative-bucket histogram in the prometheus sense"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+        self.count += 1
+        self.sum += value
+
+    def prometheus_lines(self, name, labels=''):
+        sep = ',' if labels else ''
+        for bound, count in zip(self.buckets, self.counts):
+            yield f'{name}_bucket{{{labels}{sep}le="{bound}"}} {count}'
+        yield f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}'
+        yield f'{name}_sum{{{labels}}} {self.sum:.6f}' if labels else f'{name}_sum {self.sum:.6f}'
+        yield f'{name}_count{{{labels}}} {self.count}' if labels else f'{name}_count {self.count}'
+
+
+class VisionEncodeStats:
+    """
+    Time per image in the vision encoder, fed from inside the model when
+    config.METRICS_VISION_ENCODE is set. The encoder runs on batches of whatever the
+    scheduler admitted, so this is an aggregate per image in the prometheus text; the page
+    records of metrics.jsonl do not carry it.
+
+    On gpu the start and end are cuda events, read once the gpu has passed them (or when
+    the stats are exported), so the forward pass never waits for the gpu.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = Histogram()
+        self.tokens = 0
+        self.pending = deque() # (start event, end event, tokens) not read yet
+
+    def start(self):
+        if not torch.cuda.is_available():
+            return time.perf_counter()
+        event = torch.cuda.Event(enable_timing=True)
+        event.record()
+        return event
+
+    def stop(self, start, num_tokens):
+        if isinstance(start, float):
+            with self.lock:
+                self._observe(time.perf_counter() - start, num_tokens)
+            return
+        end = torch.cuda.Event(enable_timing=True)
+        end.record()
+        with self.lock:
+            self.pending.append((start, end, num_tokens))
+            self._resolve(wait=False)
+
+    def resolve(self):
+        """reads every pending timing, waiting for the gpu if needed; before exporting"""
+        with self.lock:
+            self._resolve(wait=True)
+
+    def _resolve(self, wait):
+        while self.pending:
+            start, end, num_tokens = self.pending[0]
+            if not wait and not end.query():
+                break
+            end.synchronize()
+            self._observe(start.elapsed_time(end) / 1000, num_tokens)
+            self.pending.popleft()
+
+    def _observe(self, seconds, num_tokens):
+        self.seconds.observe(seconds)
+        self.tokens += num_tokens
+
+
+vision_encode_stats = VisionEncodeStats()
+
+
+class MetricsRecorder:
+    """
+    Per-page stage timings, token counts and finish reason.
+
+    Stages are added as they happen and the page record is written to `path` (jsonl) by
+    finish(). Aggregates over all finished pages are available as prometheus text.
+
+    Args:
+        path: jsonl output, or None to keep only the aggregates.
+        describe: key -> dict of json-able fields identifying the page.
+        image_token_id: prompt tokens with this id are counted as vision tokens.
+    """
+
+    def __init__(self, path=None, describe=None, image_token_id=None):
+        self.describe = describe or (lambda key: {'key': key})
+        self.image_token_id = image_token_id
+        self.lock = threading.Lock()
+        self.records = {}
+        self.stage_seconds = defaultdict(Histogram)
+        self.pages = defaultdict(int)
+        self.tokens = defaultdict(int)
+        self.afile = open(path, 'a', encoding='utf-8') if path else None
+
+    def add(self, key, **fields):
+        with self.lock:
+            self.records.setdefault(key, {}).update(fields)
+
+    def add_time(self, key, stage, seconds):
+        with self.lock:
+            self.records.setdefault(key, {}).setdefault('seconds', {})[stage] = seconds
+
+    @contextmanager
+    def timed(self, key, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(key, stage, time.perf_counter() - start)
+
+    def add_output(self, key, output):
+        """token counts, finish reason and engine-side stages of a RequestOutput"""
+        completion = output.outputs[0]
+        fields = {'finish_reason': completion.finish_reason}
+        if getattr(completion, 'token_ids', None) is not None:
+            fields['output_tokens'] = len(completion.token_ids)
+        prompt_token_ids = getattr(output, 'prompt_token_ids', None)
+        if prompt_token_ids is not None:
+            fields['prompt_tokens'] = len(prompt_token_ids)
+            if self.image_token_id is not None:
+                fields['vision_tokens'] = sum(1 for token_id in prompt_token_ids if token_id == self.image_token_id)
+        self.add(key, **fields)
+
+        # pages replayed from the journal / text layer never saw the engine
+        metrics = getattr(output, 'metrics', None)
+        if metrics is None or metrics.first_token_time is None:
+            return
+        if metrics.time_in_queue is not None:
+            self.add_time(key, 'queue', metrics.time_in_queue)
+        if metrics.first_scheduled_time is not None:
+            # the vision encoder runs inside the prefill step
+            self.add_time(key, 'prefill', metrics.first_token_time - metrics.first_scheduled_time)
+        self.add_time(key, 'ttft', metrics.first_token_time - metrics.arrival_time)
+        self.add_time(key, 'decode', metrics.last_token_time - metrics.first_token_time)
+
+    def finish(self, key):
+        with self.lock:
+            record = self.records.pop(key, {})
+            for stage, seconds in record.get('seconds', {}).items():
+                self.stage_seconds[stage].observe(seconds)
+            self.pages[record.get('finish_reason')] += 1
+            for kind in ('vision', 'prompt', 'output'):
+                self.tokens[kind] += record.get(f'{kind}_tokens', 0)
+
+            if self.afile is not None:
+                self.afile.write(json.dumps({**self.describe(key), **record}, ensure_ascii=False) + '\n')
+                self.afile.flush()
+
+    def prometheus_text(self):
+        with self.lock:
+            lines = [
+                '# HELP ocr_stage_seconds Time a page spent in each pipeline stage.',
+                '# TYPE ocr_stage_seconds histogram',
+            ]
+            for stage in sorted(self.stage_seconds, key=lambda stage: STAGES.index(stage) if stage in STAGES else len(STAGES)):
+                lines.extend(self.stage_seconds[stage].prometheus_lines('ocr_stage_seconds', f'stage="{stage}"'))
+
+            lines += ['# HELP ocr_pages_total Finished pages by finish reason.', '# TYPE ocr_pages_total counter']
+            for finish_reason, count in self.pages.items():
+                lines.append(f'ocr_pages_total{{finish_reason="{finish_reason}"}} {count}')
+
+            lines += ['# HELP ocr_tokens_total Tokens of finished pages.', '# TYPE ocr_tokens_total counter']
+            for kind, count in self.tokens.items():
+                lines.append(f'ocr_tokens_total{{kind="{kind}"}} {count}')
+
+        vision_encode_stats.resolve()
+        with vision_encode_stats.lock:
+            if vision_encode_stats.seconds.count:
+                lines += ['# HELP ocr_vision_encode_seconds Vision encoder time per image.',
+                          '# TYPE ocr_vision_encode_seconds histogram']
+                lines.extend(vision_encode_stats.seconds.prometheus_lines('ocr_vision_encode_seconds'))
+                lines += ['# TYPE ocr_vision_encode_tokens_total counter',
+                          f'ocr_vision_encode_tokens_total {vision_encode_stats.tokens}']
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        text = self.prometheus_text()
+        with open(path, 'w', encoding='utf-8') as afile:
+            afile.write(text)
+
+    def close(self):
+        if self.afile is not None:
+            self.afile.close()
+            self.afile = None
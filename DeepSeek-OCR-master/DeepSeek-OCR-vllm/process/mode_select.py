@@ -0,0 +1,109 @@
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image
+
+from config import BASE_SIZE, IMAGE_SIZE, CROP_MODE
+from process.image_process import count_image_tokens, count_tiles
+from process.page_order import ink_ratio
+
+
+class ResolutionMode(NamedTuple):
+    base_size: int
+    image_size: int
+    crop_mode: bool
+
+
+MODES = {
+    'tiny': ResolutionMode(512, 512, False),
+    'small': ResolutionMode(640, 640, False),
+    'base': ResolutionMode(1024, 1024, False),
+    'large': ResolutionMode(1280, 1280, False),
+    'gundam': ResolutionMode(1024, 640, True),
+}
+
+CONFIG_MODE = ResolutionMode(BASE_SIZE, IMAGE_SIZE, CROP_MODE)
+
+
+def mode_name(mode):
+    return next((name for name, other in MODES.items() if other == mode), f'{mode.base_size}/{mode.image_size}/{mode.crop_mode}')
+
+
+class TextLines(NamedTuple):
+    count: int
+    line_height: float # median text line height, as a share of the page height; 0 without lines
+
+
+def text_lines(image, side=1024, contrast=64, min_ink=0.002, max_line=0.1):
+    """
+    Text lines from the horizontal projection profile of a thumbnail: runs of rows where at
+    least `min_ink` of the pixels differ from the paper colour by `contrast` grey levels
+    (dark text on light paper and light text on dark slides alike). Runs taller than
+    `max_line` of the page are figures or photos, not lines.
+    """
+    scale = side / max(image.size)
+    if scale < 1:
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.BOX)
+    gray = np.asarray(image.convert('L'), dtype=np.int16)
+    background = np.bincount(gray.ravel(), minlength=256).argmax()
+    rows = (np.abs(gray - background) >= contrast).mean(axis=1) >= min_ink
+
+    # run boundaries of the text rows
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], rows.astype(np.int8), [0]))))
+    heights = edges[1::2] - edges[::2]
+    heights = heights[(heights >= 2) & (heights <= max_line * len(rows))]
+    if not len(heights):
+        return TextLines(0, 0.0)
+    return TextLines(len(heights), float(np.median(heights)) / len(rows))
+
+
+def largest_view(mode):
+    """side of the largest view the encoders see in `mode`: the global view, or the tiles if larger"""
+    return max(mode.base_size, mode.image_size) if mode.crop_mode else mode.base_size
+
+
+def view_height(mode, image_width, image_height):
+    """height in pixels the page gets in the views of `mode` (the larger of the global view and the tiles)"""
+    if mode.crop_mode and (image_width > 640 or image_height > 640):
+        _, num_height_tiles = count_tiles(image_width, image_height, image_size=mode.image_size)
+        return max(mode.image_size * num_height_tiles, mode.base_size * image_height / max(image_width, image_height))
+    if mode.image_size <= 640 and not mode.crop_mode:
+        # stretched to a square, see tokenize_with_images
+        return mode.image_size
+    return mode.base_size * image_height / max(image_width, image_height)
+
+
+def select_mode(image, ceiling=CONFIG_MODE, min_glyph_px=12, max_compression=10, tokens_per_ink=20000):
+    """
+    The mode with the fewest vision tokens that is predicted to be enough for the page, up
+    to the `ceiling` mode (config.py): candidates have fewer tokens for the page and no
+    larger views than it, so no page costs more than it would without selection and the
+    encoder memory the engine profiled in the ceiling mode still holds (with Gundam, Large
+    and its 1280 global view are never picked). A mode is enough when
+
+      - text lines are at least `min_glyph_px` high in its views, and
+      - the predicted output (ink ratio, see page_order) is at most `max_compression` text
+        tokens per vision token; decoding stays ~97% precise up to 10x in the DeepSeek-OCR paper.
+
+    Pages without text lines (photos, figures only) get the ceiling mode. The default
+    thresholds are unvalidated starting points, see config.ADAPTIVE_MODE.
+    """
+    lines = text_lines(image)
+    ceiling_tokens = count_image_tokens(image.width, image.height, cropping=ceiling.crop_mode,
+                                        base_size=ceiling.base_size, image_size=ceiling.image_size)
+    if not lines.count:
+        return ceiling
+
+    text_tokens = ink_ratio(image) * tokens_per_ink
+    candidates = []
+    for mode in MODES.values():
+        tokens = count_image_tokens(image.width, image.height, cropping=mode.crop_mode,
+                                    base_size=mode.base_size, image_size=mode.image_size)
+        if tokens < ceiling_tokens and largest_view(mode) <= largest_view(ceiling):
+            candidates.append((tokens, mode))
+
+    for tokens, mode in sorted(candidates, key=lambda candidate: candidate[0]):
+        glyph_px = lines.line_height * view_height(mode, image.width, image.height)
+        if glyph_px >= min_glyph_px and tokens * max_compression >= text_tokens:
+            return mode
+    return ceiling
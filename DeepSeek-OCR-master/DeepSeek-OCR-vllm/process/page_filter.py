@@ -0,0 +1,71 @@
+from collections import deque
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image
+
+from process.page_order import gray_histogram
+
+
+def dark_fraction(image, contrast=64, side=512):
+    """share of thumbnail pixels at least `contrast` grey levels darker than the paper"""
+    histogram, background = gray_histogram(image, side)
+    return sum(histogram[:max(0, background - contrast + 1)]) / sum(histogram)
+
+
+def is_blank(image, max_dark=5e-5):
+    """
+    No ink worth a model call: separator pages, empty backs of scans. Paper texture and
+    scanner noise stay within `contrast` of the paper colour and do not count; a page
+    number alone is around 1e-4.
+    """
+    return dark_fraction(image) <= max_dark
+
+
+class PageSignature(NamedTuple):
+    aspect: float
+    dhash: int # 64-bit difference hash, for the candidate search
+    thumbnail: np.ndarray # grey, side x side, to confirm a candidate
+
+
+def page_signature(image, side=128):
+    gray = image.convert('L') if image.mode != 'L' else image
+    thumbnail = np.asarray(gray.resize((side, side), Image.BOX), dtype=np.int16)
+    small = np.asarray(gray.resize((9, 8), Image.BOX), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    dhash = int(''.join('1' if bit else '0' for bit in bits), 2)
+    return PageSignature(image.width / image.height, dhash, thumbnail)
+
+
+class PageDeduper:
+    """
+    Near-duplicate pages among the recent ones: the same aspect ratio, a 64-bit dhash within
+    `max_distance` bits and a mean absolute difference of the 128 px thumbnails of at most
+    `max_diff` grey levels. The dhash alone groups different pages of the same layout, the
+    thumbnail check is what tells them apart.
+
+    Each entry holds the value registered for the first page of its group (the pipeline
+    stores a future of its output there). The last `max_entries` groups are kept.
+    """
+
+    def __init__(self, max_distance=6, max_diff=1.5, max_entries=1024):
+        self.max_distance = max_distance
+        self.max_diff = max_diff
+        self.entries = deque(maxlen=max_entries)
+
+    def signature(self, image):
+        """thread-safe, meant for a worker pool"""
+        return page_signature(image)
+
+    def find(self, signature):
+        for other, value in reversed(self.entries):
+            if abs(other.aspect - signature.aspect) > 0.01 * signature.aspect:
+                continue
+            if bin(other.dhash ^ signature.dhash).count('1') > self.max_distance:
+                continue
+            if np.abs(other.thumbnail - signature.thumbnail).mean() <= self.max_diff:
+                return value
+        return None
+
+    def add(self, signature, value):
+        self.entries.append((signature, value))
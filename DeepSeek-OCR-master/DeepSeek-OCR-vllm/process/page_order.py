@@ -0,0 +1,66 @@
+import heapq
+from typing import NamedTuple
+
+from PIL import Image
+
+from config import CROP_MODE
+from process.image_process import count_image_tokens
+
+
+class PageCost(NamedTuple):
+    vision_tokens: int # prefill, exact
+    decode_tokens: int # output length, predicted
+
+
+def gray_histogram(image, side=512):
+    """grey level histogram of a box-filtered thumbnail and its most common level (the paper colour)"""
+    scale = side / max(image.size)
+    if scale < 1:
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.BOX)
+    histogram = image.convert('L').histogram()
+    return histogram, max(range(256), key=histogram.__getitem__)
+
+
+def ink_ratio(image, side=512):
+    """
+    Darkness of the page above its paper colour, 0 (blank) .. 1 (solid black). Taken as the
+    mean on a box-filtered thumbnail, so thin strokes count even when downsampling greys
+    them out, relative to the most common grey level, so scanned paper does not count as ink.
+    """
+    histogram, background = gray_histogram(image, side)
+    if background == 0:
+        return 0.0
+    ink = sum(count * (background - level) for level, count in enumerate(histogram[:background]))
+    return ink / (sum(histogram) * background)
+
+
+def estimate_cost(image, cropping=CROP_MODE, tokens_per_ink=20000, max_tokens=8192):
+    """
+    Vision tokens from the tile plan and a rough output length from the ink ratio (a dense
+    text page is ~0.1 ink, ~2k tokens). Only the ranking of pages matters for plan_order.
+    """
+    vision_tokens = count_image_tokens(image.width, image.height, cropping=cropping)
+    decode_tokens = min(max_tokens, max(1, round(ink_ratio(image) * tokens_per_ink)))
+    return PageCost(vision_tokens, decode_tokens)
+
+
+def plan_order(costs, bucket_tokens=256):
+    """
+    Submission order, as indices into `costs`: longest predicted output first, so long
+    pages start early and short ones fill the free slots at the end of a batch. Outputs
+    are bucketed to `bucket_tokens`; within a bucket larger prefills go first and equal
+    pages keep their input order.
+    """
+    return sorted(range(len(costs)),
+                  key=lambda idx: (-(costs[idx].decode_tokens // bucket_tokens), -costs[idx].vision_tokens))
+
+
+def simulate_makespan(decode_tokens, num_slots):
+    """
+    Decode steps to finish every request in submission order on `num_slots` sequence slots,
+    one token per running request per step and a freed slot refilled right away.
+    """
+    slots = [0] * min(num_slots, len(decode_tokens))
+    for tokens in decode_tokens:
+        heapq.heapreplace(slots, slots[0] + tokens)
+    return max(slots, default=0)
@@ -0,0 +1,173 @@
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import fitz
+import numpy as np
+from PIL import Image
+
+
+# per-worker open documents, so a worker parses each pdf once, not once per page
+_MAX_OPEN_DOCUMENTS = 8
+_documents = OrderedDict()
+
+
+def _open_document(pdf_path):
+    doc = _documents.get(pdf_path)
+    if doc is None:
+        if len(_documents) >= _MAX_OPEN_DOCUMENTS:
+            _, oldest = _documents.popitem(last=False)
+            oldest.close()
+        doc = _documents[pdf_path] = fitz.open(pdf_path)
+    else:
+        _documents.move_to_end(pdf_path)
+    return doc
+
+
+def _render_page(pdf_path, page_idx, zoom):
+    """worker: rasterize one page into a shared memory block, return its handle"""
+    page = _open_document(pdf_path)[page_idx]
+    pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+
+    samples = pixmap.samples_mv if hasattr(pixmap, 'samples_mv') else pixmap.samples
+    shm = shared_memory.SharedMemory(create=True, size=max(len(samples), 1))
+    shm.buf[:len(samples)] = samples
+    shm.close()
+
+    return page_idx, shm.name, pixmap.width, pixmap.height, pixmap.stride
+
+
+def _image_from_shared_memory(name, width, height, stride):
+    """parent: copy the raw RGB samples out of shared memory (no png encode/decode)"""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        rows = np.ndarray((height, stride), dtype=np.uint8, buffer=shm.buf)
+        pixels = rows[:, :width * 3].reshape(height, width, 3).copy()
+        del rows
+    finally:
+        shm.close()
+        shm.unlink()
+    return Image.fromarray(pixels, 'RGB')
+
+
+def _release(future):
+    try:
+        _, name, _, _, _ = future.result()
+        shm = shared_memory.SharedMemory(name=name)
+        shm.close()
+        shm.unlink()
+    except Exception:
+        pass
+
+
+def _noop():
+    return None
+
+
+def _page_zoom(pdf_document, page_idx, dpi):
+    """dpi is a number or a callable (page_width, page_height) in points -> dpi"""
+    if callable(dpi):
+        rect = pdf_document[page_idx].rect
+        dpi = dpi(rect.width, rect.height)
+    return dpi / 72.0
+
+
+def get_page_count(pdf_path):
+    with fitz.open(pdf_path) as pdf_document:
+        return pdf_document.page_count
+
+
+def iter_pdf_images(pdf_path, dpi=144, image_format="PNG"):
+    """
+    pdf2images, serially and lazily: yields (page_idx, image) one page at a time
+    """
+    pdf_document = fitz.open(pdf_path)
+
+    try:
+        for page_num in range(pdf_document.page_count):
+            page = pdf_document[page_num]
+
+            zoom = _page_zoom(pdf_document, page_num, dpi)
+            matrix = fitz.Matrix(zoom, zoom)
+
+            # alpha=False always gives 3-channel rgb samples, so no alpha flattening is needed
+            pixmap = page.get_pixmap(matrix=matrix, alpha=False)
+            img = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples, 'raw', 'RGB', pixmap.stride)
+
+            yield page_num, img
+    finally:
+        pdf_document.close()
+
+
+def pdf_to_images_high_quality(pdf_path, dpi=144, image_format="PNG"):
+    """
+    pdf2images
+    """
+    return [img for _, img in iter_pdf_images(pdf_path, dpi=dpi, image_format=image_format)]
+
+
+class PdfRenderPool:
+    """
+    Rasterizes pdf pages on a process pool. Each worker opens its own fitz document
+    and hands the raw rgb pixmap back through shared memory.
+
+    Create it before the vLLM engine: with the default fork context all workers are
+    started on the first submit, before CUDA is initialized in the parent.
+    """
+
+    def __init__(self, num_workers, mp_context='fork'):
+        self.num_workers = num_workers
+        # children inherit the tracker, so blocks they create are unregistered by our unlink
+        resource_tracker.ensure_running()
+        self.executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context(mp_context),
+        )
+        self.executor.submit(_noop).result()
+
+    def iter_pages(self, pdf_path, dpi=144, prefetch=None, page_indices=None):
+        """
+        yields (page_idx, image) in page order; at most `prefetch` pages are rendered ahead
+        of the consumer. dpi is a number or a callable (page_width, page_height) -> dpi.
+        """
+        prefetch = prefetch or 2 * self.num_workers
+        # page boxes are read here so the dpi callable never has to cross into the workers
+        pdf_document = fitz.open(pdf_path)
+        if page_indices is None:
+            page_indices = range(pdf_document.page_count)
+        page_iter = iter(page_indices)
+
+        def submit(page_idx):
+            zoom = _page_zoom(pdf_document, page_idx, dpi)
+            pending.append(self.executor.submit(_render_page, pdf_path, page_idx, zoom))
+
+        pending = deque()
+        try:
+            for page_idx in page_iter:
+                submit(page_idx)
+                if len(pending) >= prefetch:
+                    break
+
+            while pending:
+                future = pending.popleft()
+                page_idx = next(page_iter, None)
+                if page_idx is not None:
+                    submit(page_idx)
+
+                page_idx, name, width, height, stride = future.result()
+                yield page_idx, _image_from_shared_memory(name, width, height, stride)
+        finally:
+            # consumer stopped early: free whatever was already rendered
+            for future in pending:
+                _release(future)
+            pdf_document.close()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
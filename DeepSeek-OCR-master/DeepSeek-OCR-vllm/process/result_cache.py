@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from process.journal import StoredOutput
+
+
+def pixel_hash(image):
+    """sha256 of the decoded pixels, so the same page hits however the file around it changed"""
+    sha = hashlib.sha256(f'{image.mode}|{image.width}x{image.height}|'.encode())
+    sha.update(image.tobytes())
+    return sha.hexdigest()
+
+
+def sampling_fingerprint(sampling_params):
+    """the generation settings a cached output depends on, logits processors included"""
+    fields = {
+        'temperature': sampling_params.temperature,
+        'max_tokens': sampling_params.max_tokens,
+        'logits_processors': [(type(processor).__name__, vars(processor))
+                              for processor in sampling_params.logits_processors or []],
+    }
+    return json.dumps(fields, sort_keys=True, default=sorted)
+
+
+class ResultCache:
+    """
+    Exact-result cache of model outputs, keyed by (page pixel hash, fingerprint), where the
+    fingerprint covers everything else the output depends on (prompt, resolution mode,
+    sampling params). Unlike the journal, which is per document and page index, it hits on
+    identical pages anywhere: boilerplate pages, forms, unchanged pages of a revised pdf.
+
+    Stored in sqlite so it survives runs and can be shared by them. Entries are evicted
+    least recently used first once their text exceeds `max_bytes`. Writes are committed
+    every `commit_every` puts and on close, not per page; a crash loses at most those
+    entries, which the journal still has.
+    """
+
+    def __init__(self, path, fingerprint='', max_bytes=1 << 30, commit_every=64):
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.touched = {} # key -> last_used of hits not written yet
+        self.uncommitted = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, text TEXT, finish_reason TEXT, '
+                        'size INTEGER, last_used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        self.db.commit()
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+
+    def _key(self, page_hash):
+        return hashlib.sha256(f'{self.fingerprint}|{page_hash}'.encode()).hexdigest()
+
+    def get(self, page_hash):
+        key = self._key(page_hash)
+        with self.lock:
+            row = self.db.execute('SELECT text, finish_reason FROM results WHERE key = ?', (key, )).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.touched[key] = time.time()
+        return StoredOutput(*row)
+
+    def put(self, page_hash, text, finish_reason):
+        key = self._key(page_hash)
+        size = len(text.encode('utf-8'))
+        with self.lock:
+            old = self.db.execute('SELECT size FROM results WHERE key = ?', (key, )).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                            (key, text, finish_reason, size, time.time()))
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self._commit()
+
+    def _write_touched(self):
+        self.db.executemany('UPDATE results SET last_used = ? WHERE key = ?',
+                            [(last_used, key) for key, last_used in self.touched.items()])
+        self.touched = {}
+
+    def _commit(self):
+        self._write_touched()
+        self.db.commit()
+        self.uncommitted = 0
+
+    def _evict(self):
+        # recent hits count as used before anything is picked
+        self._write_touched()
+        # down to 90% so eviction does not run on every put once full
+        target = int(self.max_bytes * 0.9)
+        while self.total_bytes > target:
+            rows = self.db.execute('SELECT key, size FROM results ORDER BY last_used LIMIT 256').fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.total_bytes <= target:
+                    break
+                self.db.execute('DELETE FROM results WHERE key = ?', (key, ))
+                self.total_bytes -= size
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            self.db.close()
@@ -0,0 +1,257 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from process.journal import StoredOutput
+from process.page_order import estimate_cost as default_estimate_cost, plan_order
+
+
+def expired_output(request_output):
+    """the partial output of a request aborted at its deadline"""
+    if request_output is None:
+        # never got past the waiting queue
+        return StoredOutput('', 'deadline')
+    request_output.outputs[0].finish_reason = 'deadline'
+    return request_output
+
+
+async def generate_stream(engine, request, sampling_params, request_id, priority=0, timeout=None):
+    """
+    engine.generate() with a priority and a deadline. `timeout` seconds after submission a
+    request that is still waiting or decoding is aborted in the engine, and its last partial
+    output is yielded once more with finish_reason 'deadline'. Lower priorities are
+    scheduled first; anything but 0 needs an engine with scheduler_policy='priority'.
+    """
+    stream = engine.generate(request, sampling_params, request_id, priority=priority)
+    if timeout is None:
+        async for request_output in stream:
+            yield request_output
+        return
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    request_output = None
+    try:
+        while request_output is None or not request_output.finished:
+            try:
+                request_output = await asyncio.wait_for(stream.__anext__(), deadline - loop.time())
+            except StopAsyncIteration:
+                return
+            yield request_output
+        return
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        await stream.aclose()
+
+    await engine.abort(request_id)
+    yield expired_output(request_output)
+
+
+async def generate_one(engine, request, sampling_params, request_id, priority=0, timeout=None):
+    """run one request to completion (or its deadline) on an AsyncLLMEngine, return the final RequestOutput"""
+    final_output = None
+    async for request_output in generate_stream(engine, request, sampling_params, request_id, priority, timeout):
+        final_output = request_output
+    return final_output
+
+
+async def stream_pages(engine, pages, preprocess, sampling_params, write, depth, num_workers, request_prefix='page',
+                       lookup=None, on_output=None, retries=(), needs_retry=None, metrics=None, preprocess_pool=None,
+                       priority=0, timeout=None, estimate_cost=None, order_window=1, admission=None, deduper=None):
+    """
+    render -> preprocess -> engine -> write, with at most `depth` pages in flight.
+
+    Args:
+        engine: AsyncLLMEngine.
+        pages: iterable of (key, image), e.g. key = page_idx or (doc_idx, page_idx);
+            consumed lazily on its own thread, so rendering can be a generator over
+            open documents.
+        preprocess: image -> engine request, run on a pool of `num_workers` threads.
+        sampling_params: SamplingParams shared by every page.
+        write: called as write(key, image, request_output) in submission order, on
+            a single writer thread.
+        depth: max number of pages between render and write; bounds peak memory
+            independently of the document length.
+        lookup: optional key -> output or None; pages it answers skip preprocessing
+            and the engine. Runs on the preprocess pool, so it may do disk I/O.
+        on_output: optional on_output(key, request_output), called on the preprocess
+            pool as soon as a page leaves the engine, before it waits for its turn to
+            be written.
+        retries: escalation steps, (preprocess, sampling_params) pairs; a page for
+            which needs_retry(request_output) holds is re-run with each step in turn
+            until one succeeds. The page keeps its place in the write order, the
+            pages behind it keep decoding meanwhile. A page aborted at its deadline
+            is final and never retried.
+        metrics: optional MetricsRecorder; gets the render, preprocess and
+            postprocess (write) time of every page and its final engine output.
+        preprocess_pool: optional executor shared with other callers (a server
+            running many documents at once); by default a private pool of
+            `num_workers` threads.
+        priority: engine priority of every request, see generate_stream.
+        timeout: per-request deadline in seconds, see generate_stream.
+        estimate_cost: optional image -> PageCost; pages are then taken in windows
+            of `order_window` and each window is submitted in plan_order (longest
+            predicted first). Writes stay in input order; up to depth + order_window
+            pages are held.
+        admission: optional KVAdmission; every request waits until its KV
+            reservation fits and may get a per-page max_tokens from it, planned from
+            the page's cost (the one computed for the order, or estimate_cost /
+            page_order.estimate_cost on the preprocess pool). A page
+            cut off by that planned budget is re-run once with the full one.
+        deduper: optional PageDeduper; a page close enough to an earlier one waits
+            for that page's output and reuses its text (finish_reason 'duplicate')
+            instead of being decoded; on_output gets it all the same. Pages answered by
+            lookup are representatives too.
+
+    Pages still in the engine are aborted if the caller is cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    # holds one task per page in submission order; put() blocks once `depth`
+    # pages are in flight, which stalls the renderer
+    in_flight = asyncio.Queue(maxsize=depth)
+
+    tasks = set() # pages not finished yet
+
+    with ExitStack() as stack:
+        render_pool = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+        write_pool = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+        if preprocess_pool is None:
+            preprocess_pool = stack.enter_context(ThreadPoolExecutor(max_workers=num_workers))
+
+        def timed_preprocess(key, preprocess, image):
+            if metrics is None:
+                return preprocess(image)
+            with metrics.timed(key, 'preprocess'):
+                return preprocess(image)
+
+        async def generate(request, params, request_id, cost=None):
+            if admission is None:
+                return await generate_one(engine, request, params, request_id, priority, timeout)
+            params, reserved = admission.plan(request, params, cost)
+            async with admission.admit(reserved):
+                return await generate_one(engine, request, params, request_id, priority, timeout)
+
+        async def run_page(seq, key, image, cost=None):
+            output = await loop.run_in_executor(preprocess_pool, lookup, key) if lookup is not None else None
+            if deduper is not None:
+                signature = await loop.run_in_executor(preprocess_pool, deduper.signature, image)
+                representative = deduper.find(signature)
+                if representative is None:
+                    result = loop.create_future()
+                    deduper.add(signature, result)
+                    if output is None:
+                        try:
+                            page = await decode_page(seq, key, image, cost)
+                        except BaseException:
+                            result.cancel()
+                            raise
+                        result.set_result(page[2])
+                        return page
+                    # answered by lookup; its near-duplicates further on reuse it all the same
+                    result.set_result(output)
+                elif output is None:
+                    try:
+                        # shielded: this page going away must not cancel the one it waits for
+                        output = await asyncio.shield(representative)
+                        output = StoredOutput(output.outputs[0].text, 'duplicate')
+                    except asyncio.CancelledError:
+                        if not representative.cancelled():
+                            raise
+                        # the representative never finished, decode this one after all
+                    else:
+                        if on_output is not None:
+                            await loop.run_in_executor(preprocess_pool, on_output, key, output)
+            if output is not None:
+                if metrics is not None:
+                    metrics.add_output(key, output)
+                return key, image, output
+
+            return await decode_page(seq, key, image, cost)
+
+        async def decode_page(seq, key, image, cost=None):
+            preprocessing = loop.run_in_executor(preprocess_pool, timed_preprocess, key, preprocess, image)
+            if cost is None and admission is not None and admission.plan_max_tokens is not None:
+                # thumbnail + histogram work, kept off the loop that drives the engine
+                cost = await loop.run_in_executor(preprocess_pool, estimate_cost or default_estimate_cost, image)
+            request = await preprocessing
+            output = await generate(request, sampling_params, f'{request_prefix}-{seq}', cost)
+            attempts = 1
+            # finish_reason is 'deadline' for an aborted page, which is never re-run
+            if (admission is not None and output.outputs[0].finish_reason == 'length'
+                    and len(output.outputs[0].token_ids) < sampling_params.max_tokens):
+                # outgrew its planned max_tokens, not the real one: once more with the full budget
+                output = await generate(request, sampling_params, f'{request_prefix}-{seq}-full')
+                attempts += 1
+            for attempt, (retry_preprocess, retry_params) in enumerate(retries):
+                if output.outputs[0].finish_reason == 'deadline' or not needs_retry(output):
+                    break
+                request = await loop.run_in_executor(preprocess_pool, retry_preprocess, image)
+                # retries get the full max_tokens of their step
+                output = await generate(request, retry_params, f'{request_prefix}-{seq}-retry{attempt}')
+                attempts += 1
+            if metrics is not None:
+                metrics.add(key, attempts=attempts)
+                metrics.add_output(key, output)
+            if on_output is not None:
+                await loop.run_in_executor(preprocess_pool, on_output, key, output)
+            return key, image, output
+
+        window_size = order_window if estimate_cost is not None else 1
+
+        async def produce():
+            page_iter = iter(pages)
+            seq = 0
+            item = ()
+            while item is not None:
+                window = []
+                while len(window) < window_size:
+                    start = time.perf_counter()
+                    item = await loop.run_in_executor(render_pool, next, page_iter, None)
+                    if item is None:
+                        break
+                    if metrics is not None:
+                        # pdf render or image load, whatever `pages` does per page
+                        metrics.add_time(item[0], 'render', time.perf_counter() - start)
+                    window.append((seq, item))
+                    seq += 1
+
+                submit = window
+                costs = [None] * len(window)
+                if len(window) > 1:
+                    costs = await asyncio.gather(*(loop.run_in_executor(preprocess_pool, estimate_cost, image)
+                                                   for _, (_, image) in window))
+                    submit = [window[idx] for idx in plan_order(costs)]
+                # admission plans max_tokens from the same costs
+                cost_of = {page_seq: cost for (page_seq, _), cost in zip(window, costs)}
+
+                window_tasks = {}
+                for page_seq, page in submit:
+                    task = window_tasks[page_seq] = asyncio.ensure_future(run_page(page_seq, *page, cost_of[page_seq]))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                for page_seq, _ in window:
+                    await in_flight.put(window_tasks[page_seq])
+            await in_flight.put(None)
+
+        async def consume():
+            while True:
+                task = await in_flight.get()
+                if task is None:
+                    break
+                result = await task
+                if metrics is None:
+                    await loop.run_in_executor(write_pool, write, *result)
+                    continue
+                start = time.perf_counter()
+                await loop.run_in_executor(write_pool, write, *result)
+                metrics.add_time(result[0], 'postprocess', time.perf_counter() - start)
+                metrics.finish(result[0])
+
+        try:
+            await asyncio.gather(produce(), consume())
+        finally:
+            # cancelling a generate() aborts its request in the engine
+            for task in list(tasks):
+                task.cancel()
@@ -0,0 +1,106 @@
+import statistics
+
+import fitz
+
+
+MIN_CHARS = 200 # fewer characters than this: cover/figure page, let the model see it
+MAX_IMAGE_COVERAGE = 0.5 # page mostly covered by raster images: a scan, whatever the text layer says
+MAX_DRAWINGS = 200 # many vector paths: tables/charts whose structure the text layer loses
+
+
+def _spans(text_dict):
+    for block in text_dict['blocks']:
+        if block.get('type', 0) != 0:
+            continue
+        for line in block['lines']:
+            for span in line['spans']:
+                yield span
+
+
+def _is_clean(char):
+    code = ord(char)
+    if char == '\ufffd' or 0xE000 <= code <= 0xF8FF:  # replacement char / private use: no ToUnicode map
+        return False
+    return char.isprintable() or char in '\t\n'
+
+
+def score_text_layer(page, text_dict=None):
+    """
+    0..1 confidence that the embedded text layer alone reproduces the page.
+    Scores 0 for empty or invisible-OCR layers (scans), and scales down with raster
+    coverage, undecodable glyphs and heavy vector content.
+    """
+    if text_dict is None:
+        text_dict = page.get_text('dict')
+    spans = list(_spans(text_dict))
+
+    text = ''.join(span['text'] for span in spans)
+    num_chars = len(text.strip())
+    if num_chars < MIN_CHARS:
+        return 0.0
+
+    # tesseract & co. put an invisible GlyphLessFont layer over the page image
+    if any('GlyphLess' in span.get('font', '') for span in spans):
+        return 0.0
+
+    clean_ratio = sum(_is_clean(char) for char in text) / len(text)
+
+    page_rect = page.rect
+    page_area = max(page_rect.width * page_rect.height, 1.0)
+    image_area = 0.0
+    for info in page.get_image_info():
+        bbox = fitz.Rect(info['bbox']) & page_rect
+        image_area += bbox.width * bbox.height
+    image_coverage = min(image_area / page_area, 1.0)
+    if image_coverage > MAX_IMAGE_COVERAGE:
+        return 0.0
+
+    score = clean_ratio * (1.0 - image_coverage)
+    if len(page.get_drawings()) > MAX_DRAWINGS:
+        score *= 0.5
+    return score
+
+
+def text_layer_markdown(page, text_dict=None):
+    """markdown from the text layer in reading order: one paragraph per block, large blocks as headings"""
+    if text_dict is None:
+        text_dict = page.get_text('dict', sort=True)
+
+    sizes = [span['size'] for span in _spans(text_dict) if span['text'].strip()]
+    if not sizes:
+        return ''
+    body_size = statistics.median(sizes)
+
+    paragraphs = []
+    for block in text_dict['blocks']:
+        if block.get('type', 0) != 0:
+            continue
+
+        text = ''
+        for line in block['lines']:
+            line_text = ''.join(span['text'] for span in line['spans']).strip()
+            if not line_text:
+                continue
+            if text.endswith('-') and line_text[:1].islower():
+                # de-hyphenate words broken across lines
+                text = text[:-1] + line_text
+            else:
+                text = f'{text} {line_text}' if text else line_text
+        if not text:
+            continue
+
+        block_size = max(span['size'] for line in block['lines'] for span in line['spans'])
+        if block_size >= 1.25 * body_size and len(text) < 200:
+            text = '## ' + text
+        paragraphs.append(text)
+
+    return '\n\n'.join(paragraphs)
+
+
+def inspect_text_layer(page, min_score):
+    """(score, markdown) where markdown is None unless the text layer is good enough to skip ocr"""
+    text_dict = page.get_text('dict', sort=True)
+    score = score_text_layer(page, text_dict)
+    if score < min_score:
+        return score, None
+    return score, text_layer_markdown(page, text_dict)
@@ -1,5 +1,4 @@
 import os
-import re
 from tqdm import tqdm
 import torch
 if torch.version.cuda == '11.8':
@@ -7,7 +6,7 @@ if torch.version.cuda == '11.8':
 os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, MAX_CONCURRENCY, CROP_MODE, NUM_WORKERS
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, MAX_CONCURRENCY, CROP_MODE, NUM_WORKERS, REQUEST_CLASSES, LENGTH_ORDER, SKIP_BLANK_PAGES, BLANK_MAX_DARK, REUSE_NEAR_DUPLICATES, ADAPTIVE_MODE, ADAPTIVE_MIN_GLYPH_PX, ADAPTIVE_MAX_COMPRESSION
 from concurrent.futures import ThreadPoolExecutor
 import glob
 from PIL import Image
@@ -18,6 +17,11 @@ from vllm.model_executor.models.registry import ModelRegistry
 from vllm import LLM, SamplingParams
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
 from process.image_process import DeepseekOCRProcessor
+from process.grounding import parse_grounding
+from process.page_order import estimate_cost, plan_order
+from process.page_filter import PageDeduper, is_blank
+from process.journal import StoredOutput
+from process.mode_select import mode_name, select_mode
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
 
@@ -38,7 +42,7 @@ logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=40, window_size=90,
 
 sampling_params = SamplingParams(
     temperature=0.0,
-    max_tokens=8192,
+    max_tokens=REQUEST_CLASSES['bulk']['max_tokens'],
     logits_processors=logits_processors,
     skip_special_tokens=False,
 )
@@ -50,44 +54,20 @@ class Colors:
     BLUE = '\033[34m'
     RESET = '\033[0m' 
 
-def clean_formula(text):
-
-    formula_pattern = r'\\\[(.*?)\\\]'
-    
-    def process_formula(match):
-        formula = match.group(1)
-
-        formula = re.sub(r'\\quad\s*\([^)]*\)', '', formula)
-        
-        formula = formula.strip()
-        
-        return r'\[' + formula + r'\]'
-
-    cleaned_text = re.sub(formula_pattern, process_formula, text)
-    
-    return cleaned_text
-
-def re_match(text):
-    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-    matches = re.findall(pattern, text, re.DOTALL)
-
-
-    # mathes_image = []
-    mathes_other = []
-    for a_match in matches:
-        mathes_other.append(a_match[0])
-    return matches, mathes_other
-
-def process_single_image(image):
-    """single image"""
+def process_single_image(image, mode=None):
+    """single image, in the config mode or `mode` (see process.mode_select)"""
     prompt_in = prompt
     cache_item = {
         "prompt": prompt_in,
-        "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
+        "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE, mode=mode)},
     }
     return cache_item
 
 
+def select_page_mode(image):
+    return select_mode(image, min_glyph_px=ADAPTIVE_MIN_GLYPH_PX, max_compression=ADAPTIVE_MAX_COMPRESSION)
+
+
 if __name__ == "__main__":
 
     # INPUT_PATH = OmniDocBench images path
@@ -122,21 +102,65 @@ if __name__ == "__main__":
     #     ]
     #     batch_inputs.extend(cache_list)
 
+    # blank pages get an empty result, near-duplicates (opt-in) the result of the first page like them
+    reuse_from = {}
+    blank = [False] * len(images)
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        if SKIP_BLANK_PAGES:
+            blank = list(executor.map(lambda image: is_blank(image, BLANK_MAX_DARK), images))
+        if REUSE_NEAR_DUPLICATES:
+            deduper = PageDeduper(max_entries=len(images))
+            for idx, signature in enumerate(executor.map(deduper.signature, images)):
+                if blank[idx]:
+                    continue
+                representative = deduper.find(signature)
+                if representative is None:
+                    deduper.add(signature, idx)
+                else:
+                    reuse_from[idx] = representative
+    to_decode = [idx for idx in range(len(images)) if not blank[idx] and idx not in reuse_from]
+    print(f'{Colors.YELLOW}{sum(blank)} blank pages, {len(reuse_from)} near-duplicates, '
+          f'{len(to_decode)} to decode{Colors.RESET}')
+
     with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:  
-        batch_inputs = list(tqdm(
-            executor.map(process_single_image, images),
-            total=len(images),
+        # the smallest sufficient resolution mode per page
+        modes = [None] * len(to_decode)
+        if ADAPTIVE_MODE:
+            modes = list(executor.map(select_page_mode, [images[idx] for idx in to_decode]))
+            counts = {}
+            for mode in modes:
+                counts[mode_name(mode)] = counts.get(mode_name(mode), 0) + 1
+            print(f'{Colors.YELLOW}modes: {", ".join(f"{name} {count}" for name, count in sorted(counts.items()))}{Colors.RESET}')
+
+        batch_inputs = dict(zip(to_decode, tqdm(
+            executor.map(process_single_image, [images[idx] for idx in to_decode], modes),
+            total=len(to_decode),
             desc="Pre-processed images"
-        ))
+        )))
 
 
     
 
+    # longest predicted pages first, so the batch does not end on a few dense pages at low occupancy
+    order = to_decode
+    if LENGTH_ORDER:
+        with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+            costs = list(executor.map(estimate_cost, [images[idx] for idx in to_decode]))
+        order = [to_decode[idx] for idx in plan_order(costs)]
+
     outputs_list = llm.generate(
-        batch_inputs,
+        [batch_inputs[idx] for idx in order],
         sampling_params=sampling_params
     )
 
+    # back to input order
+    outputs_by_input = [StoredOutput('', 'blank')] * len(images)
+    for idx, output in zip(order, outputs_list):
+        outputs_by_input[idx] = output
+    for idx, representative in reuse_from.items():
+        outputs_by_input[idx] = outputs_by_input[representative]
+    outputs_list = outputs_by_input
+
 
     output_path = OUTPUT_PATH
 
@@ -150,10 +174,7 @@ if __name__ == "__main__":
         with open(mmd_det_path, 'w', encoding='utf-8') as afile:
             afile.write(content)
 
-        content = clean_formula(content)
-        matches_ref, mathes_other = re_match(content)
-        for idx, a_match_other in enumerate(tqdm(mathes_other, desc="other")):
-            content = content.replace(a_match_other, '').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n').replace('<center>', '').replace('</center>', '')
+        content = parse_grounding(content, replacements={'<center>': '', '</center>': ''}, clean_formulas=True).markdown
         
         mmd_path = output_path + image.split('/')[-1].replace('.jpg', '.md')
 
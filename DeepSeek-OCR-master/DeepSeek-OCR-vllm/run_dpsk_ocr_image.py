@@ -1,5 +1,4 @@
 import asyncio
-import re
 import os
 
 import torch
@@ -14,17 +13,25 @@ from vllm.engine.arg_utils import AsyncEngineArgs
 from vllm.model_executor.models.registry import ModelRegistry
 import time
 from deepseek_ocr import DeepseekOCRForCausalLM
-from PIL import Image, ImageDraw, ImageFont, ImageOps
-import numpy as np
-from tqdm import tqdm
+from PIL import Image, ImageOps
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
 from process.image_process import DeepseekOCRProcessor
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, CROP_MODE
+from process.grounding import FigureCropWriter, GroundingParser, MARKDOWN_REPLACEMENTS, REF_OPEN, draw_layout, parse_grounding
+from process.stream_pipeline import generate_stream
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, CROP_MODE, REQUEST_CLASSES
 
 
 
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
+class Colors:
+    RED = '\033[31m'
+    GREEN = '\033[32m'
+    YELLOW = '\033[33m'
+    BLUE = '\033[34m'
+    RESET = '\033[0m' 
+
+
 def load_image(image_path):
 
     try:
@@ -42,106 +49,21 @@ def load_image(image_path):
             return None
 
 
-def re_match(text):
-    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-    matches = re.findall(pattern, text, re.DOTALL)
-
-
-    mathes_image = []
-    mathes_other = []
-    for a_match in matches:
-        if '<|ref|>image<|/ref|>' in a_match[0]:
-            mathes_image.append(a_match[0])
-        else:
-            mathes_other.append(a_match[0])
-    return matches, mathes_image, mathes_other
-
-
-def extract_coordinates_and_label(ref_text, image_width, image_height):
-
-
-    try:
-        label_type = ref_text[1]
-        cor_list = eval(ref_text[2])
-    except Exception as e:
-        print(e)
-        return None
-
-    return (label_type, cor_list)
-
-
-def draw_bounding_boxes(image, refs):
-
-    image_width, image_height = image.size
-    img_draw = image.copy()
-    draw = ImageDraw.Draw(img_draw)
-
-    overlay = Image.new('RGBA', img_draw.size, (0, 0, 0, 0))
-    draw2 = ImageDraw.Draw(overlay)
-    
-    #     except IOError:
-    font = ImageFont.load_default()
-
-    img_idx = 0
-    
-    for i, ref in enumerate(refs):
-        try:
-            result = extract_coordinates_and_label(ref, image_width, image_height)
-            if result:
-                label_type, points_list = result
-                
-                color = (np.random.randint(0, 200), np.random.randint(0, 200), np.random.randint(0, 255))
-
-                color_a = color + (20, )
-                for points in points_list:
-                    x1, y1, x2, y2 = points
-
-                    x1 = int(x1 / 999 * image_width)
-                    y1 = int(y1 / 999 * image_height)
-
-                    x2 = int(x2 / 999 * image_width)
-                    y2 = int(y2 / 999 * image_height)
-
-                    if label_type == 'image':
-                        try:
-                            cropped = image.crop((x1, y1, x2, y2))
-                            cropped.save(f"{OUTPUT_PATH}/images/{img_idx}.jpg")
-                        except Exception as e:
-                            print(e)
-                            pass
-                        img_idx += 1
-                        
-                    try:
-                        if label_type == 'title':
-                            draw.rectangle([x1, y1, x2, y2], outline=color, width=4)
-                            draw2.rectangle([x1, y1, x2, y2], fill=color_a, outline=(0, 0, 0, 0), width=1)
-                        else:
-                            draw.rectangle([x1, y1, x2, y2], outline=color, width=2)
-                            draw2.rectangle([x1, y1, x2, y2], fill=color_a, outline=(0, 0, 0, 0), width=1)
-
-                        text_x = x1
-                        text_y = max(0, y1 - 15)
-                            
-                        text_bbox = draw.textbbox((0, 0), label_type, font=font)
-                        text_width = text_bbox[2] - text_bbox[0]
-                        text_height = text_bbox[3] - text_bbox[1]
-                        draw.rectangle([text_x, text_y, text_x + text_width, text_y + text_height], 
-                                    fill=(255, 255, 255, 30))
-                        
-                        draw.text((text_x, text_y), label_type, font=font, fill=color)
-                    except:
-                        pass
-        except:
-            continue
-    img_draw.paste(overlay, (0, 0), overlay)
-    return img_draw
-
-
-def process_image_with_refs(image, ref_texts):
-    result_image = draw_bounding_boxes(image, ref_texts)
-    return result_image
+def print_block(block):
+    print(f'{Colors.BLUE}[{block.label}] {block.boxes}{Colors.RESET}')
+    print(block.text, flush=True)
 
 
+def print_preamble(text, printed):
+    """
+    streams the raw text before the first grounding block, holding back what may be the
+    start of its tag; returns how far it has printed
+    """
+    start = text.find(REF_OPEN, printed)
+    end = start if start >= 0 else max(printed, len(text) - len(REF_OPEN) + 1)
+    if end > printed:
+        print(text[printed:end], end='', flush=True)
+    return end
 
 
 async def stream_generate(image=None, prompt=''):
@@ -161,9 +83,11 @@ async def stream_generate(image=None, prompt=''):
     
     logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=30, window_size=90, whitelist_token_ids= {128821, 128822})] #whitelist: <td>, </td> 
 
+    request_class = REQUEST_CLASSES['interactive']
+
     sampling_params = SamplingParams(
         temperature=0.0,
-        max_tokens=8192,
+        max_tokens=request_class['max_tokens'],
         logits_processors=logits_processors,
         skip_special_tokens=False,
         # ignore_eos=False,
@@ -174,6 +98,12 @@ async def stream_generate(image=None, prompt=''):
 
     printed_length = 0  
 
+    # grounding output is printed block by block, each as soon as it is complete
+    parser = None
+    preamble_length = 0
+    if '<|grounding|>' in prompt:
+        parser = GroundingParser(replacements={**MARKDOWN_REPLACEMENTS, '<｜end▁of▁sentence｜>': ''})
+
     if image and '<image>' in prompt:
         request = {
             "prompt": prompt,
@@ -185,16 +115,31 @@ async def stream_generate(image=None, prompt=''):
         }
     else:
         assert False, f'prompt is none!!!'
-    async for request_output in engine.generate(
-        request, sampling_params, request_id
+    # past the deadline the request is aborted and what it has produced so far is kept
+    async for request_output in generate_stream(
+        engine, request, sampling_params, request_id, timeout=request_class['deadline']
     ):
         if request_output.outputs:
             full_text = request_output.outputs[0].text
             new_text = full_text[printed_length:]
-            print(new_text, end='', flush=True)
+            if parser is None:
+                print(new_text, end='', flush=True)
+            else:
+                blocks = parser.feed(new_text)
+                preamble_length = print_preamble(full_text, preamble_length)
+                for block in blocks:
+                    print_block(block)
             printed_length = len(full_text)
             final_output = full_text
+    if parser is not None:
+        # without any complete block (no tags, or cut off inside the first) the raw text is all there is
+        if not parser.blocks:
+            print(final_output[preamble_length:], end='', flush=True)
+        for block in parser.finish():
+            print_block(block)
     print('\n') 
+    if request_output.outputs[0].finish_reason == 'deadline':
+        print(f'{Colors.YELLOW}aborted after {request_class["deadline"]}s, the result is partial{Colors.RESET}')
 
     return final_output
 
@@ -232,16 +177,11 @@ if __name__ == "__main__":
         with open(f'{OUTPUT_PATH}/result_ori.mmd', 'w', encoding = 'utf-8') as afile:
             afile.write(outputs)
 
-        matches_ref, matches_images, mathes_other = re_match(outputs)
-        # print(matches_ref)
-        result = process_image_with_refs(image_draw, matches_ref)
-
-
-        for idx, a_match_image in enumerate(tqdm(matches_images, desc="image")):
-            outputs = outputs.replace(a_match_image, f'![](images/' + str(idx) + '.jpg)\n')
+        parsed = parse_grounding(outputs, image_link=lambda idx: f'images/{idx}.jpg', collapse_newlines=False)
+        crop_writer = FigureCropWriter()
+        result = draw_layout(image_draw, parsed.blocks, crop_writer, f'{OUTPUT_PATH}/images/')
 
-        for idx, a_match_other in enumerate(tqdm(mathes_other, desc="other")):
-            outputs = outputs.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+        outputs = parsed.markdown
 
         # if 'structural formula' in conversation[0]['content']:
         #     outputs = '<smiles>' + outputs + '</smiles>'
@@ -301,3 +241,4 @@ if __name__ == "__main__":
             plt.close()
 
         result.save(f'{OUTPUT_PATH}/result_with_boxes.jpg')
+        crop_writer.close()
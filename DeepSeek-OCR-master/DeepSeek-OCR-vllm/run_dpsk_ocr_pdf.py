@@ -1,11 +1,14 @@
+import asyncio
+import glob
+import json
 import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import NamedTuple, Optional
 import fitz
-import img2pdf
-import io
-import re
 from tqdm import tqdm
 import torch
-from concurrent.futures import ThreadPoolExecutor
  
 
 if torch.version.cuda == '11.8':
@@ -14,22 +17,35 @@ os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
 
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, MAX_NUM_SEQS, KV_ADMISSION, KV_ADMISSION_HEADROOM, NUM_WORKERS, CROP_MODE, BASE_SIZE, IMAGE_SIZE, MIN_CROPS, MAX_CROPS, ADAPTIVE_MODE, ADAPTIVE_MIN_GLYPH_PX, ADAPTIVE_MAX_COMPRESSION, QUEUE_DEPTH, LENGTH_ORDER, ORDER_WINDOW, RENDER_WORKERS, RENDER_DPI, RENDER_OVERSAMPLE, RESUME, SKIP_BLANK_PAGES, BLANK_MAX_DARK, REUSE_NEAR_DUPLICATES, RESULT_CACHE_PATH, RESULT_CACHE_MAX_MB, HYBRID_TEXT_LAYER, TEXT_LAYER_MIN_SCORE, LAYOUT_JPEG_QUALITY, LAYOUT_MAX_SIDE, LAYOUT_WORKERS, LAYOUT_TABLE, RETRY_POLICY, REQUEST_CLASSES, METRICS
 
-from PIL import Image, ImageDraw, ImageFont
-import numpy as np
+from PIL import Image, ImageOps
 from deepseek_ocr import DeepseekOCRForCausalLM
 
 from vllm.model_executor.models.registry import ModelRegistry
 
-from vllm import LLM, SamplingParams
+from vllm import AsyncLLMEngine, SamplingParams
+from vllm.engine.arg_utils import AsyncEngineArgs
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
+from process.image_process import DeepseekOCRProcessor, plan_render_dpi
+from process.stream_pipeline import stream_pages
+from process.pdf_render import PdfRenderPool, get_page_count, iter_pdf_images
+from process.journal import PageJournal, StoredOutput, file_hash
+from process.page_filter import PageDeduper, is_blank
+from process.result_cache import ResultCache, pixel_hash, sampling_fingerprint
+from process.text_layer import inspect_text_layer
+from process.layout_pdf import LayoutPdfWriter
+from process.layout_table import LayoutTableWriter
+from process.metrics import MetricsRecorder
+from process.page_order import estimate_cost
+from process.mode_select import select_mode
+from process.admission import KVAdmission, kv_cache_tokens, plan_max_tokens
+from process.grounding import FigureCropWriter, draw_layout, parse_grounding
 
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
 
-llm = LLM(
+engine_args = AsyncEngineArgs(
     model=MODEL_PATH,
     hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
     block_size=256,
@@ -37,21 +53,33 @@ llm = LLM(
     trust_remote_code=True, 
     max_model_len=8192,
     swap_space=0,
-    max_num_seqs=MAX_CONCURRENCY,
+    max_num_seqs=MAX_NUM_SEQS,
     tensor_parallel_size=1,
     gpu_memory_utilization=0.9,
-    disable_mm_preprocessor_cache=True
+    disable_mm_preprocessor_cache=True,
+    scheduler_policy='priority',
 )
 
-logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
+request_class = REQUEST_CLASSES['bulk']
 
-sampling_params = SamplingParams(
-    temperature=0.0,
-    max_tokens=8192,
-    logits_processors=logits_processors,
-    skip_special_tokens=False,
-    include_stop_str_in_output=True,
-)
+def make_sampling_params(ngram_size=20, window_size=50, max_tokens=8192):
+    logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=ngram_size, window_size=window_size, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
+
+    return SamplingParams(
+        temperature=0.0,
+        max_tokens=max_tokens,
+        logits_processors=logits_processors,
+        skip_special_tokens=False,
+        include_stop_str_in_output=True,
+    )
+
+
+sampling_params = make_sampling_params(max_tokens=request_class['max_tokens'])
+
+
+PDF_EXTENSIONS = ('.pdf',)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+MANIFEST_EXTENSIONS = ('.txt',)
 
 
 class Colors:
@@ -61,270 +89,391 @@ class Colors:
     BLUE = '\033[34m'
     RESET = '\033[0m' 
 
-def pdf_to_images_high_quality(pdf_path, dpi=144, image_format="PNG"):
-    """
-    pdf2images
-    """
-    images = []
-    
-    pdf_document = fitz.open(pdf_path)
-    
-    zoom = dpi / 72.0
-    matrix = fitz.Matrix(zoom, zoom)
-    
-    for page_num in range(pdf_document.page_count):
-        page = pdf_document[page_num]
-
-        pixmap = page.get_pixmap(matrix=matrix, alpha=False)
-        Image.MAX_IMAGE_PIXELS = None
-
-        if image_format.upper() == "PNG":
-            img_data = pixmap.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-        else:
-            img_data = pixmap.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-            if img.mode in ('RGBA', 'LA'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
-        
-        images.append(img)
-    
-    pdf_document.close()
-    return images
-
-def pil_to_pdf_img2pdf(pil_images, output_path):
-
-    if not pil_images:
-        return
-    
-    image_bytes_list = []
-    
-    for img in pil_images:
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        img_buffer = io.BytesIO()
-        img.save(img_buffer, format='JPEG', quality=95)
-        img_bytes = img_buffer.getvalue()
-        image_bytes_list.append(img_bytes)
-    
-    try:
-        pdf_bytes = img2pdf.convert(image_bytes_list)
-        with open(output_path, "wb") as f:
-            f.write(pdf_bytes)
-
-    except Exception as e:
-        print(f"error: {e}")
-
-
-
-def re_match(text):
-    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-    matches = re.findall(pattern, text, re.DOTALL)
-
-
-    mathes_image = []
-    mathes_other = []
-    for a_match in matches:
-        if '<|ref|>image<|/ref|>' in a_match[0]:
-            mathes_image.append(a_match[0])
-        else:
-            mathes_other.append(a_match[0])
-    return matches, mathes_image, mathes_other
-
-
-def extract_coordinates_and_label(ref_text, image_width, image_height):
-
-
-    try:
-        label_type = ref_text[1]
-        cor_list = eval(ref_text[2])
-    except Exception as e:
-        print(e)
-        return None
-
-    return (label_type, cor_list)
-
-
-def draw_bounding_boxes(image, refs, jdx):
-
-    image_width, image_height = image.size
-    img_draw = image.copy()
-    draw = ImageDraw.Draw(img_draw)
-
-    overlay = Image.new('RGBA', img_draw.size, (0, 0, 0, 0))
-    draw2 = ImageDraw.Draw(overlay)
-    
-    #     except IOError:
-    font = ImageFont.load_default()
-
-    img_idx = 0
-    
-    for i, ref in enumerate(refs):
-        try:
-            result = extract_coordinates_and_label(ref, image_width, image_height)
-            if result:
-                label_type, points_list = result
-                
-                color = (np.random.randint(0, 200), np.random.randint(0, 200), np.random.randint(0, 255))
-
-                color_a = color + (20, )
-                for points in points_list:
-                    x1, y1, x2, y2 = points
-
-                    x1 = int(x1 / 999 * image_width)
-                    y1 = int(y1 / 999 * image_height)
-
-                    x2 = int(x2 / 999 * image_width)
-                    y2 = int(y2 / 999 * image_height)
-
-                    if label_type == 'image':
-                        try:
-                            cropped = image.crop((x1, y1, x2, y2))
-                            cropped.save(f"{OUTPUT_PATH}/images/{jdx}_{img_idx}.jpg")
-                        except Exception as e:
-                            print(e)
-                            pass
-                        img_idx += 1
-                        
-                    try:
-                        if label_type == 'title':
-                            draw.rectangle([x1, y1, x2, y2], outline=color, width=4)
-                            draw2.rectangle([x1, y1, x2, y2], fill=color_a, outline=(0, 0, 0, 0), width=1)
-                        else:
-                            draw.rectangle([x1, y1, x2, y2], outline=color, width=2)
-                            draw2.rectangle([x1, y1, x2, y2], fill=color_a, outline=(0, 0, 0, 0), width=1)
-
-                        text_x = x1
-                        text_y = max(0, y1 - 15)
-                            
-                        text_bbox = draw.textbbox((0, 0), label_type, font=font)
-                        text_width = text_bbox[2] - text_bbox[0]
-                        text_height = text_bbox[3] - text_bbox[1]
-                        draw.rectangle([text_x, text_y, text_x + text_width, text_y + text_height], 
-                                    fill=(255, 255, 255, 30))
-                        
-                        draw.text((text_x, text_y), label_type, font=font, fill=color)
-                    except:
-                        pass
-        except:
-            continue
-    img_draw.paste(overlay, (0, 0), overlay)
-    return img_draw
-
-
-def process_image_with_refs(image, ref_texts, jdx):
-    result_image = draw_bounding_boxes(image, ref_texts, jdx)
-    return result_image
-
-
-def process_single_image(image):
-    """single image"""
+def process_single_image(image, cropping=CROP_MODE, adaptive=ADAPTIVE_MODE):
+    """single image; `adaptive` picks the resolution mode from the page (process.mode_select)"""
     prompt_in = prompt
+    mode = None
+    if adaptive:
+        mode = select_mode(image, min_glyph_px=ADAPTIVE_MIN_GLYPH_PX, max_compression=ADAPTIVE_MAX_COMPRESSION)
     cache_item = {
         "prompt": prompt_in,
-        "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
+        "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=cropping, mode=mode)},
     }
     return cache_item
 
 
-if __name__ == "__main__":
-
-    os.makedirs(OUTPUT_PATH, exist_ok=True)
-    os.makedirs(f'{OUTPUT_PATH}/images', exist_ok=True)
-    
-    print(f'{Colors.RED}PDF loading .....{Colors.RESET}')
-
+def page_failed(output):
+    """
+    no eos: the page ran into max_tokens, usually a repetition loop. A page aborted at its
+    deadline is final, not failed: retrying would give it the deadline again per step.
+    """
+    if output.outputs[0].finish_reason == 'deadline':
+        return False
+    return '<｜end▁of▁sentence｜>' not in output.outputs[0].text
 
-    images = pdf_to_images_high_quality(INPUT_PATH)
 
+# escalation steps for failed pages, see RETRY_POLICY; always in the config mode, the
+# first retry of an adaptive page is also its escalation to full resolution
+retries = [
+    (partial(process_single_image, cropping=step.get('crop_mode', CROP_MODE), adaptive=False),
+     make_sampling_params(step.get('ngram_size', 20), step.get('window_size', 50), step.get('max_tokens', request_class['max_tokens'])))
+    for step in RETRY_POLICY
+]
 
-    prompt = PROMPT
 
-    # batch_inputs = []
+def load_image(image_path):
 
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:  
-        batch_inputs = list(tqdm(
-            executor.map(process_single_image, images),
-            total=len(images),
-            desc="Pre-processed images"
-        ))
+    try:
+        image = Image.open(image_path)
 
+        corrected_image = ImageOps.exif_transpose(image)
 
-    # for image in tqdm(images):
+        return corrected_image.convert('RGB')
 
-    #     prompt_in = prompt
-    #     cache_list = [
-    #         {
-    #             "prompt": prompt_in,
-    #             "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE)},
-    #         }
-    #     ]
-    #     batch_inputs.extend(cache_list)
+    except Exception as e:
+        print(f"error: {e}")
+        return None
 
 
-    outputs_list = llm.generate(
-        batch_inputs,
-        sampling_params=sampling_params
-    )
+def list_corpus(input_path):
+    """pdfs and images under a directory (recursively), listed one per line in a manifest file, or a single image"""
+    if os.path.isdir(input_path):
+        paths = sorted(glob.glob(f'{input_path}/**/*', recursive=True))
+    elif input_path.lower().endswith(IMAGE_EXTENSIONS):
+        paths = [input_path]
+    else:
+        with open(input_path, 'r', encoding='utf-8') as afile:
+            paths = [line.strip() for line in afile if line.strip()]
+    return [path for path in paths if path.lower().endswith(PDF_EXTENSIONS + IMAGE_EXTENSIONS)]
 
 
-    output_path = OUTPUT_PATH
+def is_corpus(input_path):
+    """False for a single pdf; a directory, manifest (.txt) or single image runs as a corpus"""
+    if not os.path.exists(input_path):
+        raise FileNotFoundError(f'INPUT_PATH does not exist: {input_path}')
+    if os.path.isdir(input_path) or input_path.lower().endswith(MANIFEST_EXTENSIONS + IMAGE_EXTENSIONS):
+        return True
+    if input_path.lower().endswith(PDF_EXTENSIONS):
+        return False
+    raise ValueError(f'INPUT_PATH must be a .pdf, an image ({", ".join(IMAGE_EXTENSIONS)}), a directory '
+                     f'or a manifest ({", ".join(MANIFEST_EXTENSIONS)}, one path per line): {input_path}')
 
-    os.makedirs(output_path, exist_ok=True)
 
+class PdfResultWriter:
+    """
+    Post-processes pages in order as they finish and appends them to the .mmd files,
+    so partial results are on disk while the rest of the document is still running.
+    """
 
-    mmd_det_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('.pdf', '_det.mmd')
-    mmd_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('pdf', 'mmd')
-    pdf_out_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('.pdf', '_layouts.pdf')
-    contents_det = ''
-    contents = ''
-    draw_images = []
-    jdx = 0
-    for output, img in zip(outputs_list, images):
+    def __init__(self, input_path, output_path, layout_executor, crop_writer, name=None, image_prefix='', record_sources=False,
+                 layout_table=None):
+        self.output_path = output_path
+
+        name = name or os.path.splitext(input_path.split('/')[-1])[0]
+        self.name = name
+        self.mmd_det_path = output_path + '/' + name + '_det.mmd'
+        self.mmd_path = output_path + '/' + name + '.mmd'
+        self.pdf_out_path = output_path + '/' + name + '_layouts.pdf'
+        # figure crops of all documents share OUTPUT_PATH/images
+        self.image_prefix = image_prefix
+        self.crop_writer = crop_writer
+
+        self.det_file = open(self.mmd_det_path, 'w', encoding='utf-8')
+        self.mmd_file = open(self.mmd_path, 'w', encoding='utf-8')
+        # hybrid mode: which path (model / text layer) every page took
+        self.sources_file = open(output_path + '/' + name + '_pages.jsonl', 'w', encoding='utf-8') if record_sources else None
+        # annotated pages are encoded on the shared pool and appended to the pdf as they come
+        self.layout_pdf = LayoutPdfWriter(self.pdf_out_path, layout_executor,
+                                          quality=LAYOUT_JPEG_QUALITY, max_side=LAYOUT_MAX_SIDE)
+        # blocks go to the corpus-wide table if given, else to this document's own
+        self.own_layout_table = layout_table is None and LAYOUT_TABLE == 'document'
+        if self.own_layout_table:
+            layout_table = LayoutTableWriter(output_path + '/' + name + '_layout.parquet')
+        self.layout_table = layout_table
+        self.mmd_offset = 0 # characters written to the .mmd so far, for the block spans
+        self.jdx = 0
+
+    def __call__(self, page_idx, img, output, text_score=None):
         content = output.outputs[0].text
+        from_text_layer = output.outputs[0].finish_reason == 'text_layer'
+
+        if self.sources_file is not None:
+            self.sources_file.write(json.dumps({
+                'page': page_idx,
+                'source': 'text_layer' if from_text_layer else 'model',
+                'text_layer_score': text_score,
+            }) + '\n')
+            self.sources_file.flush()
 
         if '<｜end▁of▁sentence｜>' in content: # repeat no eos
             content = content.replace('<｜end▁of▁sentence｜>', '')
-        else:
+        elif not from_text_layer:
             if SKIP_REPEAT:
-                continue
+                return
 
-        
+        jdx = self.image_prefix + str(self.jdx)
         page_num = f'\n<--- Page Split --->'
 
-        contents_det += content + f'\n{page_num}\n'
+        self.det_file.write(content + f'\n{page_num}\n')
 
-        image_draw = img.copy()
+        parsed = parse_grounding(content, image_link=lambda idx: f'images/{jdx}_{idx}.jpg')
+        result_image = draw_layout(img, parsed.blocks, self.crop_writer, f'{OUTPUT_PATH}/images/{jdx}_',
+                                   max_side=LAYOUT_MAX_SIDE)
 
-        matches_ref, matches_images, mathes_other = re_match(content)
-        # print(matches_ref)
-        result_image = process_image_with_refs(image_draw, matches_ref, jdx)
+        self.layout_pdf.add(result_image)
 
+        if self.layout_table is not None:
+            self.layout_table.add_page(self.name, page_idx, parsed.blocks, offset=self.mmd_offset)
 
-        draw_images.append(result_image)
+        page_markdown = parsed.markdown + f'\n{page_num}\n'
+        self.mmd_file.write(page_markdown)
+        self.mmd_offset += len(page_markdown)
 
+        self.det_file.flush()
+        self.mmd_file.flush()
 
-        for idx, a_match_image in enumerate(matches_images):
-            content = content.replace(a_match_image, f'![](images/' + str(jdx) + '_' + str(idx) + '.jpg)\n')
+        self.jdx += 1
 
-        for idx, a_match_other in enumerate(mathes_other):
-            content = content.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n')
+    def close(self):
+        self.det_file.close()
+        self.mmd_file.close()
+        if self.sources_file is not None:
+            self.sources_file.close()
 
+        self.layout_pdf.close()
+        if self.own_layout_table:
+            self.layout_table.close()
 
-        contents += content + f'\n{page_num}\n'
 
+class PageKey(NamedTuple):
+    doc_idx: int
+    page_idx: int
+    is_last: bool
+    doc_hash: str
+    # hybrid mode: text layer score, and its markdown when good enough to skip the model
+    text_score: Optional[float] = None
+    text_layer: Optional[str] = None
+    # result cache: sha256 of the rendered pixels
+    page_hash: Optional[str] = None
+    blank: bool = False
 
-        jdx += 1
 
-    with open(mmd_det_path, 'w', encoding='utf-8') as afile:
-        afile.write(contents_det)
+class CorpusResultWriter:
+    """
+    Routes pages of many documents to one PdfResultWriter each, and finalizes a
+    document (layout pdf included) as soon as its last page has been written.
+    """
+
+    def __init__(self, input_paths, output_path, corpus=True):
+        self.input_paths = input_paths
+        self.output_path = output_path
+        self.corpus = corpus
+        self.writers = {}
+        self.layout_executor = ThreadPoolExecutor(max_workers=LAYOUT_WORKERS)
+        self.crop_writer = FigureCropWriter(num_workers=LAYOUT_WORKERS)
+        self.layout_table = LayoutTableWriter(output_path + '/layout.parquet') if LAYOUT_TABLE == 'corpus' else None
+
+        # unique output names when documents in different folders share a basename
+        self.names = []
+        seen = {}
+        for input_path in input_paths:
+            name = os.path.splitext(input_path.split('/')[-1])[0]
+            seen[name] = seen.get(name, 0) + 1
+            self.names.append(name if seen[name] == 1 else f'{name}_{seen[name] - 1}')
+
+    def __call__(self, key, img, output):
+        doc_idx, page_idx, is_last = key.doc_idx, key.page_idx, key.is_last
+        writer = self.writers.get(doc_idx)
+        if writer is None:
+            name = self.names[doc_idx]
+            writer = self.writers[doc_idx] = PdfResultWriter(
+                self.input_paths[doc_idx], self.output_path, self.layout_executor, self.crop_writer, name=name,
+                image_prefix=f'{name}_' if self.corpus else '',
+                record_sources=HYBRID_TEXT_LAYER, layout_table=self.layout_table)
+
+        writer(page_idx, img, output, text_score=key.text_score)
+
+        if is_last:
+            self.writers.pop(doc_idx).close()
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        self.layout_executor.shutdown(wait=True)
+        self.crop_writer.close()
+        if self.layout_table is not None:
+            self.layout_table.close()
+
+
+def iter_corpus_pages(input_paths, render_pool, dpi):
+    """yields (PageKey, image) over every page of every document"""
+    for doc_idx, input_path in enumerate(input_paths):
+        if input_path.lower().endswith(PDF_EXTENSIONS):
+            try:
+                num_pages = get_page_count(input_path)
+                doc_hash = file_hash(input_path)
+            except Exception as e:
+                print(f"error: {input_path}: {e}")
+                continue
+            if render_pool is not None:
+                pages = render_pool.iter_pages(input_path, dpi=dpi)
+            else:
+                pages = iter_pdf_images(input_path, dpi=dpi)
+        else:
+            image = load_image(input_path)
+            if image is None:
+                continue
+            num_pages = 1
+            doc_hash = file_hash(input_path)
+            pages = [(0, image)]
+
+        # hybrid mode scores each pdf page's embedded text layer on the way through
+        text_document = None
+        if HYBRID_TEXT_LAYER and input_path.lower().endswith(PDF_EXTENSIONS):
+            text_document = fitz.open(input_path)
+
+        try:
+            for page_idx, image in pages:
+                text_score, text_layer = None, None
+                if text_document is not None:
+                    text_score, text_layer = inspect_text_layer(text_document[page_idx], TEXT_LAYER_MIN_SCORE)
+                # checked and hashed here, on the render thread, not on the event loop
+                blank = SKIP_BLANK_PAGES and text_layer is None and is_blank(image, BLANK_MAX_DARK)
+                page_hash = pixel_hash(image) if RESULT_CACHE_PATH and text_layer is None and not blank else None
+                yield PageKey(doc_idx, page_idx, page_idx == num_pages - 1, doc_hash, text_score, text_layer,
+                              page_hash, blank), image
+        finally:
+            if text_document is not None:
+                text_document.close()
+
+
+async def run_documents(input_paths, output_path, corpus=True):
+    """
+    OCR every page of every document on one engine; pages of different documents
+    share the same continuous batch.
+    """
+    # fork the render workers before the engine initializes CUDA
+    render_pool = PdfRenderPool(RENDER_WORKERS) if RENDER_WORKERS > 0 else None
+
+    engine = AsyncLLMEngine.from_engine_args(engine_args)
+
+    # concurrency follows the KV cache the engine ended up with after profiling
+    admission = None
+    if KV_ADMISSION:
+        admission = KVAdmission(kv_cache_tokens(engine), engine_args.block_size,
+                                plan_max_tokens=partial(plan_max_tokens, headroom=KV_ADMISSION_HEADROOM,
+                                                        max_tokens=request_class['max_tokens']))
+
+    dpi = RENDER_DPI or partial(plan_render_dpi, oversample=RENDER_OVERSAMPLE)
+
+    # everything a page's output depends on besides its pixels; journal and result cache
+    # entries made under other settings are not replayed
+    fingerprint = '|'.join([PROMPT, str(BASE_SIZE), str(IMAGE_SIZE), str(CROP_MODE), str(MIN_CROPS), str(MAX_CROPS),
+                            sampling_fingerprint(sampling_params), json.dumps(RETRY_POLICY, sort_keys=True),
+                            json.dumps(request_class, sort_keys=True)])
+    if ADAPTIVE_MODE:
+        fingerprint += f'|adaptive {ADAPTIVE_MIN_GLYPH_PX} {ADAPTIVE_MAX_COMPRESSION}'
+
+    # pages already in the journal are replayed instead of decoded again; the
+    # output files are rebuilt from it on every run
+    journal = None
+    if RESUME:
+        journal = PageJournal(f'{output_path}/journal.jsonl',
+                              fingerprint=fingerprint)
+        if len(journal):
+            print(f'{Colors.YELLOW}resuming: {len(journal)} pages in the journal{Colors.RESET}')
+
+    # identical pages anywhere (other documents, earlier revisions, earlier runs) are not decoded again
+    result_cache = None
+    if RESULT_CACHE_PATH:
+        result_cache = ResultCache(RESULT_CACHE_PATH, fingerprint=fingerprint, max_bytes=RESULT_CACHE_MAX_MB << 20)
+
+    def lookup(key):
+        if key.text_layer is not None:
+            return StoredOutput(key.text_layer, 'text_layer')
+        if key.blank:
+            # what the model answers for an empty page
+            return StoredOutput('<｜end▁of▁sentence｜>', 'blank')
+        output = journal.get(key.doc_hash, key.page_idx) if journal is not None else None
+        # failed pages are given their retries again instead of being replayed
+        if output is not None and retries and page_failed(output):
+            output = None
+        if output is None and result_cache is not None:
+            output = result_cache.get(key.page_hash)
+        return output
+
+    def on_output(key, output):
+        if journal is not None:
+            journal.append(key.doc_hash, key.page_idx, output.outputs[0].text, output.outputs[0].finish_reason)
+        # only finished pages: a failed one may finish on a later run with other settings
+        if result_cache is not None and not page_failed(output):
+            result_cache.put(key.page_hash, output.outputs[0].text, output.outputs[0].finish_reason)
+
+    writer = CorpusResultWriter(input_paths, output_path, corpus=corpus)
+    progress = tqdm(total=None if corpus else get_page_count(input_paths[0]), desc="Pages")
+
+    def write(key, img, output):
+        writer(key, img, output)
+        progress.update(1)
+
+    # per-page stage timings; the prometheus text is rewritten at the end and on `kill -USR1`
+    metrics = None
+    metrics_prom_path = f'{output_path}/metrics.prom'
+    if METRICS:
+        metrics = MetricsRecorder(f'{output_path}/metrics.jsonl',
+                                  describe=lambda key: {'doc': writer.names[key.doc_idx], 'page': key.page_idx},
+                                  image_token_id=DeepseekOCRProcessor().image_token_id)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, metrics.write_prometheus, metrics_prom_path)
 
-    with open(mmd_path, 'w', encoding='utf-8') as afile:
-        afile.write(contents)
+    try:
+        await stream_pages(
+            engine,
+            iter_corpus_pages(input_paths, render_pool, dpi),
+            process_single_image,
+            sampling_params,
+            write,
+            depth=QUEUE_DEPTH,
+            num_workers=NUM_WORKERS,
+            lookup=lookup,
+            on_output=on_output,
+            retries=retries,
+            needs_retry=page_failed,
+            metrics=metrics,
+            priority=request_class['priority'],
+            timeout=request_class['deadline'],
+            estimate_cost=partial(estimate_cost, max_tokens=request_class['max_tokens']) if LENGTH_ORDER else None,
+            order_window=ORDER_WINDOW,
+            admission=admission,
+            deduper=PageDeduper() if REUSE_NEAR_DUPLICATES else None,
+        )
+    finally:
+        progress.close()
+        writer.close()
+        if metrics is not None:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+            metrics.write_prometheus(metrics_prom_path)
+            metrics.close()
+        if journal is not None:
+            journal.close()
+        if result_cache is not None:
+            print(f'{Colors.YELLOW}result cache: {result_cache.hits} pages reused, {result_cache.misses} decoded{Colors.RESET}')
+            result_cache.close()
+        if render_pool is not None:
+            render_pool.shutdown()
 
 
-    pil_to_pdf_img2pdf(draw_images, pdf_out_path)
+if __name__ == "__main__":
+
+    os.makedirs(OUTPUT_PATH, exist_ok=True)
+    os.makedirs(f'{OUTPUT_PATH}/images', exist_ok=True)
+
+    prompt = PROMPT
 
+    if is_corpus(INPUT_PATH):
+        input_paths = list_corpus(INPUT_PATH)
+        print(f'{Colors.RED}corpus streaming: {len(input_paths)} documents .....{Colors.RESET}')
+        asyncio.run(run_documents(input_paths, OUTPUT_PATH, corpus=True))
+    else:
+        print(f'{Colors.RED}PDF streaming .....{Colors.RESET}')
+        asyncio.run(run_documents([INPUT_PATH], OUTPUT_PATH, corpus=False))
@@ -0,0 +1,250 @@
+import asyncio
+import io
+import json
+import os
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import torch
+
+
+if torch.version.cuda == '11.8':
+    os.environ["TRITON_PTXAS_PATH"] = "/usr/local/cuda-11.8/bin/ptxas"
+os.environ['VLLM_USE_V1'] = '0'
+os.environ["CUDA_VISIBLE_DEVICES"] = '0'
+
+
+from config import MODEL_PATH, PROMPT, MAX_NUM_SEQS, KV_ADMISSION, KV_ADMISSION_HEADROOM, NUM_WORKERS, CROP_MODE, QUEUE_DEPTH, RENDER_WORKERS, RENDER_DPI, RENDER_OVERSAMPLE, SERVER_HOST, SERVER_PORT, REQUEST_CLASSES, SERVER_DEADLINES
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from PIL import Image, ImageOps
+from deepseek_ocr import DeepseekOCRForCausalLM
+
+from vllm.model_executor.models.registry import ModelRegistry
+
+from vllm import AsyncLLMEngine, SamplingParams
+from vllm.engine.arg_utils import AsyncEngineArgs
+from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
+from process.image_process import DeepseekOCRProcessor, plan_render_dpi
+from process.stream_pipeline import generate_stream, stream_pages
+from process.pdf_render import PdfRenderPool, iter_pdf_images
+from process.admission import KVAdmission, kv_cache_tokens, plan_max_tokens
+from process.grounding import GroundingParser, MARKDOWN_REPLACEMENTS, parse_grounding
+
+ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
+
+
+engine_args = AsyncEngineArgs(
+    model=MODEL_PATH,
+    hf_overrides={"architectures": ["DeepseekOCRForCausalLM"]},
+    block_size=256,
+    enforce_eager=False,
+    trust_remote_code=True,
+    max_model_len=8192,
+    swap_space=0,
+    max_num_seqs=MAX_NUM_SEQS,
+    tensor_parallel_size=1,
+    gpu_memory_utilization=0.9,
+    disable_mm_preprocessor_cache=True,
+    # interactive images go ahead of (and preempt) bulk pdf pages
+    scheduler_policy='priority',
+)
+
+
+def make_sampling_params(max_tokens=8192):
+    logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
+
+    return SamplingParams(
+        temperature=0.0,
+        max_tokens=max_tokens,
+        logits_processors=logits_processors,
+        skip_special_tokens=False,
+        include_stop_str_in_output=True,
+    )
+
+
+# one per request class, see config.REQUEST_CLASSES
+sampling_params = {name: make_sampling_params(request_class['max_tokens']) for name, request_class in REQUEST_CLASSES.items()}
+
+
+# created once in __main__, shared by every request
+engine = None
+preprocess_pool = None
+render_pool = None
+# pdf pages only; interactive images bypass it and rely on priority preemption
+admission = None
+
+app = FastAPI()
+
+
+def process_single_image(image, prompt=PROMPT):
+    """single image"""
+    cache_item = {
+        "prompt": prompt,
+        "multi_modal_data": {"image": DeepseekOCRProcessor().tokenize_with_images(images = [image], bos=True, eos=True, cropping=CROP_MODE, prompt=prompt)},
+    }
+    return cache_item
+
+
+def load_image_bytes(data):
+    image = Image.open(io.BytesIO(data))
+    return ImageOps.exif_transpose(image).convert('RGB')
+
+
+def page_result(text, finish_reason):
+    """raw model text -> json-able result with the clean markdown and the layout blocks"""
+    finished = '<｜end▁of▁sentence｜>' in text
+    parsed = parse_grounding(text.replace('<｜end▁of▁sentence｜>', ''))
+    return {
+        'text': text,
+        'markdown': parsed.markdown,
+        'blocks': [{'label': block.label, 'boxes': block.boxes, 'start': block.start, 'end': block.end}
+                   for block in parsed.blocks],
+        'finish_reason': finish_reason,
+        'finished': finished,
+    }
+
+
+def block_event(block):
+    return {'type': 'block', 'label': block.label, 'boxes': block.boxes, 'text': block.text}
+
+
+async def stream_image(image, prompt, request_id, request_class, deadline):
+    """text deltas, plus a `block` event as soon as a layout block and its markdown are complete"""
+    loop = asyncio.get_running_loop()
+    request = await loop.run_in_executor(preprocess_pool, process_single_image, image, prompt)
+
+    parser = GroundingParser(replacements={**MARKDOWN_REPLACEMENTS, '<｜end▁of▁sentence｜>': ''})
+    printed_length = 0
+    final_output = None
+    async for request_output in generate_stream(engine, request, sampling_params[request_class], request_id,
+                                                REQUEST_CLASSES[request_class]['priority'], deadline):
+        full_text = request_output.outputs[0].text
+        if len(full_text) > printed_length:
+            new_text = full_text[printed_length:]
+            yield {'type': 'delta', 'text': new_text}
+            for block in parser.feed(new_text):
+                yield block_event(block)
+            printed_length = len(full_text)
+        final_output = request_output
+
+    for block in parser.finish():
+        yield block_event(block)
+
+    yield {'type': 'done', **page_result(final_output.outputs[0].text, final_output.outputs[0].finish_reason)}
+
+
+async def stream_pdf(data, prompt, request_id, request_class, deadline):
+    """pages come back in order as soon as each one (and every page before it) is done"""
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    # the render workers open documents by path
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as afile:
+        afile.write(data)
+        pdf_path = afile.name
+
+    dpi = RENDER_DPI or partial(plan_render_dpi, oversample=RENDER_OVERSAMPLE)
+    if render_pool is not None:
+        pages = render_pool.iter_pages(pdf_path, dpi=dpi)
+    else:
+        pages = iter_pdf_images(pdf_path, dpi=dpi)
+
+    def write(page_idx, image, output):
+        event = {'type': 'page', 'page': page_idx, **page_result(output.outputs[0].text, output.outputs[0].finish_reason)}
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    async def run():
+        try:
+            await stream_pages(engine, pages, partial(process_single_image, prompt=prompt), sampling_params[request_class],
+                               write, depth=QUEUE_DEPTH, num_workers=NUM_WORKERS, request_prefix=request_id,
+                               preprocess_pool=preprocess_pool, priority=REQUEST_CLASSES[request_class]['priority'],
+                               timeout=deadline, admission=admission)
+            events.put_nowait({'type': 'done'})
+        except Exception as e:
+            events.put_nowait({'type': 'error', 'error': str(e)})
+
+    task = asyncio.ensure_future(run())
+    try:
+        while True:
+            event = await events.get()
+            yield event
+            if event['type'] in ('done', 'error'):
+                break
+    finally:
+        # client went away: cancelling aborts the pages still in the engine
+        task.cancel()
+        os.unlink(pdf_path)
+
+
+async def ndjson(events):
+    async for event in events:
+        yield json.dumps(event, ensure_ascii=False) + '\n'
+
+
+@app.get('/health')
+async def health():
+    return {'status': 'ok'}
+
+
+@app.post('/ocr')
+async def ocr(request: Request):
+    """
+    body: the raw image or pdf bytes; ?prompt= overrides config.PROMPT.
+    ?class= is a config.REQUEST_CLASSES name (default: interactive for an image, bulk
+    for a pdf), ?deadline= overrides its deadline (config.SERVER_DEADLINES) in seconds
+    (per page for a pdf).
+    Streams newline-delimited json events: text deltas and a final result for an
+    image, one result per page for a pdf. Requests past their deadline are aborted
+    and return their partial text with finish_reason 'deadline'.
+    """
+    data = await request.body()
+    prompt = request.query_params.get('prompt', PROMPT)
+    if prompt.count('<image>') != 1:
+        return JSONResponse({'error': 'the prompt needs exactly one <image>'}, status_code=400)
+    is_pdf = data[:5] == b'%PDF-'
+    request_class = request.query_params.get('class', 'bulk' if is_pdf else 'interactive')
+    if request_class not in REQUEST_CLASSES:
+        return JSONResponse({'error': f'class must be one of {list(REQUEST_CLASSES)}'}, status_code=400)
+    deadline = SERVER_DEADLINES.get(request_class, REQUEST_CLASSES[request_class]['deadline'])
+    if 'deadline' in request.query_params:
+        try:
+            deadline = float(request.query_params['deadline'])
+        except ValueError:
+            return JSONResponse({'error': 'deadline must be a number of seconds'}, status_code=400)
+    request_id = uuid.uuid4().hex
+
+    if is_pdf:
+        events = stream_pdf(data, prompt, request_id, request_class, deadline)
+    else:
+        try:
+            image = await asyncio.get_running_loop().run_in_executor(preprocess_pool, load_image_bytes, data)
+        except Exception as e:
+            return JSONResponse({'error': f'not an image or pdf: {e}'}, status_code=400)
+        events = stream_image(image, prompt, request_id, request_class, deadline)
+
+    return StreamingResponse(ndjson(events), media_type='application/x-ndjson')
+
+
+if __name__ == "__main__":
+
+    # fork the render workers before the engine initializes CUDA
+    render_pool = PdfRenderPool(RENDER_WORKERS) if RENDER_WORKERS > 0 else None
+    preprocess_pool = ThreadPoolExecutor(max_workers=NUM_WORKERS)
+
+    # model load and graph capture happen once, here
+    engine = AsyncLLMEngine.from_engine_args(engine_args)
+    if KV_ADMISSION:
+        admission = KVAdmission(kv_cache_tokens(engine), engine_args.block_size,
+                                plan_max_tokens=partial(plan_max_tokens, headroom=KV_ADMISSION_HEADROOM,
+                                                        max_tokens=REQUEST_CLASSES['bulk']['max_tokens']))
+
+    try:
+        uvicorn.run(app, host=SERVER_HOST, port=SERVER_PORT)
+    finally:
+        preprocess_pool.shutdown(wait=False)
+        if render_pool is not None:
+            render_pool.shutdown()
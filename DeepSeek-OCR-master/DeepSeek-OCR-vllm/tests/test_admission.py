@@ -0,0 +1,33 @@
+import math
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip('torch')
+Image = pytest.importorskip('PIL.Image')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from process.admission import KVAdmission
+from process.image_process import DeepseekOCRProcessor
+
+
+def test_plan_reserves_the_whole_prompt():
+    image = Image.new('RGB', (1240, 1754), color=(255, 255, 255))
+    request = {
+        'prompt': '<image>\nFree OCR.',
+        'multi_modal_data': {'image': DeepseekOCRProcessor().tokenize_with_images(
+            images=[image], bos=True, eos=True, prompt='<image>\nFree OCR.')},
+    }
+    input_ids = request['multi_modal_data']['image'][0][0]
+    num_image_tokens = request['multi_modal_data']['image'][0][5][0]
+    assert input_ids.shape[0] == 1
+    prompt_tokens = input_ids.shape[-1]
+    assert prompt_tokens > num_image_tokens
+
+    admission = KVAdmission(budget_tokens=1 << 20, block_size=16)
+    params, reserved = admission.plan(request, SimpleNamespace(max_tokens=1024))
+    assert params.max_tokens == 1024
+    assert reserved == math.ceil((prompt_tokens + 1024) / 16) * 16